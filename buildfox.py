@@ -6,13 +6,15 @@ import os
 import re
 import sys
 import copy
+import glob
 import argparse
 import subprocess
 
 from lib_engine import Engine
+from lib_cache import Cache, Manifest
 from lib_environment import discover
 from lib_selftest import selftest_setup, selftest_wipe
-from lib_util import cxx_defines, cxx_includedirs
+from lib_util import cxx_defines, cxx_includedirs, DirCache, PathTable
 from lib_ide_vs import gen_vs
 from lib_ide_xcode import gen_xcode
 from lib_ide_make import gen_make
@@ -31,7 +33,7 @@ fox_core = r"""
 ninja_required_version = 1.3
 
 # some basic ignore folders
-excluded_dirs = .git .hg .svn
+excluded_dirs = .git .hg .svn .buildfox
 
 filter toolset:msc
 	# msc support
@@ -314,6 +316,30 @@ filter toolset: r"gcc|clang"
 
 # main app -----------------------------------------------------------
 
+# comma separated values of these variables generate one ninja file per value
+variant_variables = ("variation", "toolset")
+
+# return command that runs buildfox script with same arguments, ninja uses it to generate ninja files again
+def generator_command(args, script):
+	parts = [script]
+	if parts[0].endswith(".py"):
+		parts.insert(0, sys.executable)
+	parts.extend(["-i", args.get("in"), "-o", args.get("out")])
+	if not args.get("core"):
+		parts.append("--no-core")
+	if not args.get("env"):
+		parts.append("--no-env")
+	if not args.get("cache"):
+		parts.append("--no-cache")
+	if args.get("scan_jobs") > 1:
+		parts.extend(["--scan-jobs", str(args.get("scan_jobs"))])
+	parts.extend(args.get("variables"))
+	parts.append("--just-generate")
+	return " ".join(["\"%s\"" % part if " " in part else part for part in parts])
+
+def run_ninja(out):
+	sys.exit(subprocess.call("ninja" + (" -f " + out if len(out) else "")))
+
 def main(*argv, **kwargs):
 	# find out if user wants help about flags or something and slice all arguments after help
 	arg_help = [sys.argv.index(v) for v in ["-h", "--help"] if v in sys.argv]
@@ -372,6 +398,12 @@ def main(*argv, **kwargs):
 		help = "disable parsing fox core definitions", default = True, dest = "core")
 	argsparser.add_argument("--no-env", action = "store_false",
 		help = "disable environment discovery", default = True, dest = "env")
+	argsparser.add_argument("--no-cache", action = "store_false",
+		help = "disable caching of parsed files in .buildfox folder", default = True, dest = "cache")
+	argsparser.add_argument("--scan-jobs", metavar = "N", type = int,
+		help = "list up to N folders at same time, helps on network file systems", default = 1, dest = "scan_jobs")
+	argsparser.add_argument("--force", action = "store_true",
+		help = "generate ninja files even if no fox files or folders changed since last run", default = False, dest = "force")
 	argsparser.add_argument("-n", "--ninja-ide-gen", action = "store_true",
 		help = "enables ninja ide generator mode (equal to --no-core --no-env)", default = False, dest = "ninja_ide_gen")
 	# It won't be checked for real. Ninja will be run only if no arguments were passed.
@@ -393,31 +425,112 @@ def main(*argv, **kwargs):
 		args["in"] = "build.ninja" if args.get("in") == "build.fox" else args.get("in")
 		args["out"] = ""
 
+	# path of script must be resolved before changing working directory
+	script = os.path.abspath(sys.argv[0])
 	if args.get("workdir"):
 		os.chdir(args.get("workdir"))
 
-	engine = Engine()
-
-	if args.get("env"):
-		env = discover()
-		for name in sorted(env.keys()):
-			engine.on_assign((name, env.get(name), "="))
-
+	# list of (variant name, variables), variant name is made from values of variant variables
+	variants = [("", [])]
 	for var in args.get("variables"):
 		parts = var.split("=")
 		if len(parts) == 2:
 			name, value = parts[0], parts[1]
-			engine.on_assign((name, value, "="))
+			values = value.split(",") if name in variant_variables else [value]
+			new_variants = []
+			for variant_name, variables in variants:
+				for value in values:
+					if len(values) > 1:
+						new_variants.append((variant_name + "_" + value if variant_name else value, variables + [(name, value)]))
+					else:
+						new_variants.append((variant_name, variables + [(name, value)]))
+			variants = new_variants
 		else:
 			raise SyntaxError("unknown argument '%s'. you should use name=value syntax to setup a variable" % var)
 
-	if args.get("core"):
-		engine.load_core(fox_core)
+	# environment, parsed files, directory listings and paths are shared between variants,
+	# parsed files are only kept in memory if they are used by many variants
+	cache = Cache(keep_in_memory = len(variants) > 1) if args.get("cache") else None
+	if cache is None and len(variants) > 1:
+		cache = Cache(None)
+	dir_cache = DirCache(args.get("scan_jobs"))
+	paths = PathTable()
+	# folder listings are stored between runs, only folders with changed mtime are listed again
+	index_key = None
+	if cache is not None and cache.path is not None:
+		index_key = cache.key("fsindex", os.getcwd())
+		dir_cache.load_index(cache.load("fsindex", index_key))
+	env = discover() if args.get("env") else {}
+
+	# fox files and scanned folders are stored next to output with their modification times,
+	# so ninja files are not generated again until something changes
+	manifest = None
+	if args.get("out") and not args.get("selftest") and not args.get("ide"):
+		key = repr((sorted([(name, value) for name, value in args.items() if name not in ["force", "just_generate"]]), sorted(env.items())))
+		manifest = Manifest(args.get("out") + ".manifest", key)
+		if not args.get("force") and manifest.up_to_date():
+			if len(sys.argv) == 1:
+				run_ninja(args.get("out"))
+			return
+
+	engines = []
+
+	def create_engine(variant_name, variables):
+		engine = Engine()
+		engines.append(engine)
+		engine.context.cache = cache
+		engine.context.dir_cache = dir_cache
+		engine.context.paths = paths
+		engine.context.variant = variant_name
+
+		for name in sorted(env.keys()):
+			engine.on_assign((name, env.get(name), "="))
+
+		for name, value in variables:
+			engine.on_assign((name, value, "="))
+
+		if args.get("core"):
+			engine.load_core(fox_core)
+		return engine
+
+	# store what was read in this run, so next runs can skip work
+	def save_state():
+		dir_cache.close()
+		if index_key:
+			cache.save("fsindex", index_key, dir_cache.index())
+			cache.prune()
+		if manifest:
+			# buildfox sources are only present next to this file if it's not deployed as single file
+			source_path = os.path.dirname(os.path.abspath(__file__))
+			inputs = [os.path.abspath(__file__)] + glob.glob(os.path.join(source_path, "lib_*.py"))
+			folders = [(path, dir_cache.mtimes.get(path), listing) for path, listing in dir_cache.listings.items()]
+			outputs = []
+			for engine in engines:
+				inputs.extend(engine.context.fox_files)
+				outputs.extend(engine.context.ninja_files)
+			manifest.save(inputs, folders, outputs, [cache.path] if cache is not None and cache.path is not None else [])
+
+	if len(variants) > 1:
+		if args.get("selftest") or args.get("ide"):
+			raise ValueError("selftest and ide generation are not supported with many variants, please provide only one %s" % " and ".join(variant_variables))
+		# one ninja file per variant, named like build_debug.ninja
+		out_name, out_ext = os.path.splitext(args.get("out"))
+		for variant_name, variables in variants:
+			engine = create_engine(variant_name, variables)
+			if out_name:
+				engine.generate(args.get("in"), "%s_%s%s" % (out_name, variant_name, out_ext), generator_command = generator_command(args, script))
+			else:
+				engine.load(args.get("in"))
+				engine.save("")
+		save_state()
+		return
+
+	engine = create_engine(*variants[0])
 
 	if args.get("selftest"):
 		fox_filename, ninja_filename, app_filename = selftest_setup()
-		engine.load(fox_filename)
-		engine.save(ninja_filename)
+		engine.generate(fox_filename, ninja_filename)
+		dir_cache.close()
 		result = not subprocess.call(["ninja", "-f", ninja_filename])
 		if result:
 			result = not subprocess.call(["./" + app_filename])
@@ -428,9 +541,11 @@ def main(*argv, **kwargs):
 			print("Selftest - failed")
 			sys.exit(1)
 	else:
-		engine.load(args.get("in"))
 		if len(args.get("out")):
-			engine.save(args.get("out"))
+			engine.generate(args.get("in"), args.get("out"), generator_command = generator_command(args, script))
+		else:
+			engine.load(args.get("in"))
+		save_state()
 
 		ide = args.get("ide")
 
@@ -454,7 +569,6 @@ def main(*argv, **kwargs):
 				args.get("ninja_ide_gen"))
 		elif ide in ["make"]:
 			gen_make(
-				args.get("in"),
 				args.get("ide_env"),
 				args.get("ninja_ide_gen"))
 		elif ide in ["qtcreator"]:
@@ -476,7 +590,7 @@ def main(*argv, **kwargs):
 		elif ide is not None:
 			raise ValueError("unknown ide '%s', available ide's : vs, vs2012, vs2013, vs2015, xcode, make, qtcreator, cmake" % ide)
 	if len(sys.argv) == 1:
-		sys.exit(subprocess.call("ninja" + (" -f " + args["out"] if len(args["out"]) else "")))
+		run_ninja(args.get("out"))
 
 if __name__ == "__main__":
 	#import cProfile, pstats, io
@@ -0,0 +1,182 @@
+# BuildFox ninja generator
+
+import os
+import re
+import sys
+import time
+import marshal
+import hashlib
+from lib_version import VERSION
+from lib_util import replace_file, DirCache
+
+# bump this when layout of cached data changes
+CACHE_FORMAT = 3
+
+# entries that weren't used for this many seconds are removed from cache folder
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+re_temp_file = re.compile(r"^(.*)\.\d+\.tmp$") # match temp file that is renamed to file in group 1 when it's written
+
+# return version of cached data, marshal format is not compatible between python versions
+def format_version():
+	return "%s %i %i.%i" % (VERSION, CACHE_FORMAT, sys.version_info[0], sys.version_info[1])
+
+# return modification time of file or directory, or None if it doesn't exist
+def input_mtime(path):
+	try:
+		return os.stat(path).st_mtime
+	except OSError:
+		return None
+
+# on disk cache of intermediate data, stored as marshal files in cache folder
+# all entries are addressed by hash of their inputs, so stale entries are never read
+# entries are also kept in memory if keep_in_memory is set, so they are not read again when many variants use them,
+# if path is None then cache is only in memory
+class Cache:
+	def __init__(self, path = ".buildfox", keep_in_memory = True):
+		self.path = path
+		self.keep_in_memory = keep_in_memory or path is None
+		self.entries = {} # (kind, key): value
+		self.used = set() # (kind, key) of entries that were loaded or saved in this run
+
+	# return hash of provided strings mixed with buildfox and python versions,
+	# because marshal format is not compatible between python versions
+	def key(self, *parts):
+		digest = self.digest()
+		for part in parts:
+			digest.update(b"\0")
+			digest.update(part if isinstance(part, bytes) else part.encode("utf-8"))
+		return digest.hexdigest()
+
+	# return hash of file contents, file is read in chunks
+	def file_key(self, filename):
+		digest = self.digest()
+		with open(filename, "rb") as f:
+			for chunk in iter(lambda: f.read(1 << 16), b""):
+				digest.update(chunk)
+		return digest.hexdigest()
+
+	def digest(self):
+		digest = hashlib.sha1()
+		digest.update(format_version().encode("utf-8"))
+		return digest
+
+	# return cached value or None if there is no such entry
+	def load(self, kind, key):
+		value = self.entries.get((kind, key))
+		if (value is not None) or (self.path is None):
+			return value
+		try:
+			with open(os.path.join(self.path, kind, key), "rb") as f:
+				value = marshal.load(f)
+		except (IOError, OSError, EOFError, ValueError, TypeError):
+			return None
+		self.used.add((kind, key))
+		if self.keep_in_memory:
+			self.entries[(kind, key)] = value
+		return value
+
+	# store value, cache is optional so failing to write it is not an error
+	def save(self, kind, key, value):
+		self.used.add((kind, key))
+		if self.keep_in_memory:
+			self.entries[(kind, key)] = value
+		if self.path is None:
+			return
+		folder = os.path.join(self.path, kind)
+		filename = os.path.join(folder, key)
+		temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+		try:
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			with open(temp_filename, "wb") as f:
+				marshal.dump(value, f)
+			replace_file(temp_filename, filename)
+		except (IOError, OSError, ValueError):
+			if os.path.isfile(temp_filename):
+				os.remove(temp_filename)
+
+	# remove entries that weren't used in this run or in last max_age seconds,
+	# modification time of entries that were used is updated, so it tells when they were used last time
+	def prune(self, max_age = CACHE_MAX_AGE):
+		if self.path is None:
+			return
+		oldest = time.time() - max_age
+		try:
+			kinds = os.listdir(self.path)
+		except OSError:
+			return
+		for kind in kinds:
+			folder = os.path.join(self.path, kind)
+			if not os.path.isdir(folder):
+				continue
+			for key in os.listdir(folder):
+				filename = os.path.join(folder, key)
+				try:
+					if (kind, key) in self.used:
+						os.utime(filename, None)
+					elif os.stat(filename).st_mtime < oldest:
+						os.remove(filename)
+				except OSError:
+					pass
+
+# files and directories that were read while generating ninja files, stored next to generated files,
+# so generation can be skipped if none of them changed, key describes everything else like variables
+class Manifest:
+	def __init__(self, filename, key):
+		self.filename = filename
+		self.key = "%s\n%s" % (format_version(), key)
+
+	# return True if ninja files were generated with same key and no inputs changed since then
+	def up_to_date(self):
+		try:
+			with open(self.filename, "rb") as f:
+				key, inputs, folders, outputs, ignored = marshal.load(f)
+		except (IOError, OSError, EOFError, ValueError, TypeError):
+			return False
+		if key != self.key:
+			return False
+		for path, mtime in inputs:
+			if input_mtime(path) != mtime:
+				return False
+		ignored = set(ignored)
+		dir_cache = DirCache()
+		for path, mtime, names in folders:
+			if input_mtime(path) != mtime and (names is None or self.folder_names(path, dir_cache.list_dir(path), ignored) != names):
+				return False
+		for path in outputs:
+			if not os.path.isfile(path):
+				return False
+		return True
+
+	# return sorted names from folder listing without files written by buildfox, or None if there is no listing,
+	# writing them changes mtime of folder, so names are compared when folder mtime is different
+	def folder_names(self, path, listing, ignored):
+		if listing is None:
+			return None
+		names = []
+		for name in listing[0] + listing[1]:
+			temp = re_temp_file.match(name)
+			if os.path.normpath(os.path.abspath(os.path.join(path, temp.group(1) if temp else name))) not in ignored:
+				names.append(name)
+		return sorted(names)
+
+	# inputs are fox files and buildfox sources, folders are (path, mtime, listing) of scanned directories,
+	# outputs are generated ninja files and ignored are other files or folders written by buildfox
+	def save(self, inputs, folders, outputs, ignored = []):
+		ignored = set([os.path.normpath(os.path.abspath(path)) for path in list(outputs) + list(ignored) + [self.filename]])
+		value = (
+			self.key,
+			[(path, input_mtime(path)) for path in sorted(set(inputs))],
+			[(path, mtime, self.folder_names(path, listing, ignored)) for path, mtime, listing in sorted(folders, key = lambda folder: folder[0])],
+			sorted(set(outputs)),
+			sorted(ignored),
+		)
+		temp_filename = "%s.%i.tmp" % (self.filename, os.getpid())
+		try:
+			with open(temp_filename, "wb") as f:
+				marshal.dump(value, f)
+			replace_file(temp_filename, self.filename)
+		except (IOError, OSError, ValueError):
+			if os.path.isfile(temp_filename):
+				os.remove(temp_filename)
@@ -3,10 +3,11 @@
 import os
 import re
 import sys
-import copy
+import hashlib
+import itertools
 import collections
-from lib_parser import parse
-from lib_util import rel_dir, wildcard_regex, find_files
+from lib_parser import parse, replay
+from lib_util import rel_dir, OutputFile, wildcard_regex, compile_regex, glob_inputs, find_files, add_generated_folder, DirCache, PathTable, file_extension, regex_extensions
 from lib_version import version_check
 
 if sys.version_info[0] < 3:
@@ -21,34 +22,111 @@ re_subst = re.compile(r"(?<!\$)(?:\$\$)*\$\{(param|path|file)\}")
 re_non_escaped_space = re.compile(r"(?<!\$)(?:\$\$)* +")
 re_path_transform = re.compile(r"^([a-zA-Z0-9_.-]+)\((.*?)(?<!\$)(?:\$\$)*\)$")
 re_base_escaped = re.compile(r"\$([\| :()])")
+re_ascii_only = re.compile(r"^[\x00-\x7f]*$")
+
+# each variable assignment gets new version, versions are unique between all engines
+variable_versions = itertools.count(1)
+
+# split transformer pattern into tuple of literal parts with slot names (param, path or file) between them,
+# so literals are at even indexes and slots are at odd indexes
+def transformer_template(pattern):
+	parts = []
+	pos = 0
+	for match in re_subst.finditer(pattern):
+		parts.append(pattern[pos:match.start()])
+		parts.append(match.group(1))
+		pos = match.end()
+	parts.append(pattern[pos:])
+	return tuple(parts)
+
+# dict like scope for child engines, reads go through to parent scope and writes only go to child,
+# so creating it is cheap, parent scope must not be changed while child is in use
+class Scope:
+	def __init__(self, parent):
+		self.parent = parent # dict or other scope
+		self.values = {}
+
+	def get(self, name, default = None):
+		if name in self.values:
+			return self.values[name]
+		return self.parent.get(name, default)
+
+	def __getitem__(self, name):
+		if name in self.values:
+			return self.values[name]
+		return self.parent[name]
+
+	def __setitem__(self, name, value):
+		self.values[name] = value
+
+	def __contains__(self, name):
+		return name in self.values or name in self.parent
+
+	# same order as in copied dict, parent values first and then new values
+	def items(self):
+		result = [(name, self.values[name] if name in self.values else value) for name, value in self.parent.items()]
+		result.extend([(name, value) for name, value in self.values.items() if name not in self.parent])
+		return result
+
+	def keys(self):
+		return [name for name, value in self.items()]
+
+	def __iter__(self):
+		return iter(self.keys())
 
 class Engine:
 	class Context:
 		def __init__(self):
 			# key is folder name that ends /, value is set of file names
 			self.generated = collections.defaultdict(set)
+			# tree of folders from generated, see lib_util.add_generated_folder
+			self.generated_tree = {}
 			# key is folder name, value is set of file names
 			self.all_files = collections.defaultdict(set)
-			# number of generated subninja files
-			self.subninja_num = 0
+			# fox files that were read and ninja files that were generated
+			self.fox_files = []
+			self.ninja_files = []
+			# generated subninja file name: number of times it was used
+			self.subninja_names = {}
+			# optional lib_cache.Cache for parsed files
+			self.cache = None
+			# directory listings, can be shared between contexts of different variants
+			self.dir_cache = DirCache()
+			# normalized paths, can be shared between contexts of different variants
+			self.paths = PathTable()
+			# name of variant if many variants are generated at once
+			self.variant = ""
+			# text: (used variable names, their versions or local values, evaluated text)
+			self.eval_cache = {}
+			# auto pattern: (match function, extensions, ignore case)
+			self.auto_patterns = {}
+			# (inputs, rel_path, excluded_dirs): result of glob_inputs
+			self.glob_cache = {}
+			# generated folder: keys of glob_cache that looked into it
+			self.glob_deps = collections.defaultdict(set)
+			# folder: keys of glob_cache with recursive globs from it, they depend on new generated folders inside of it
+			self.glob_recursive_deps = collections.defaultdict(set)
 
 	def __init__(self, parent = None):
 		if not parent:
 			self.variables = {} # name: value
+			self.versions = {} # name: version of value
 			self.auto_presets = {} # name: (inputs, outputs, assigns)
 			self.rel_path = "" # this should be prepended to all parsed paths
 			self.rules = {} # rule_name: {var_name: var_value}
-			self.transformers = {} # target: pattern
-			self.excluded_dirs = set()
+			self.transformers = {} # target: template from transformer_template
+			self.excluded_dirs = frozenset()
 			self.context = Engine.Context()
 		else:
-			self.variables = copy.copy(parent.variables)
-			self.auto_presets = copy.copy(parent.auto_presets)
+			self.variables = Scope(parent.variables)
+			self.versions = Scope(parent.versions)
+			self.auto_presets = Scope(parent.auto_presets)
 			self.rel_path = parent.rel_path
-			self.rules = copy.copy(parent.rules)
-			self.transformers = copy.copy(parent.transformers)
-			self.excluded_dirs = copy.copy(parent.excluded_dirs)
+			self.rules = Scope(parent.rules)
+			self.transformers = Scope(parent.transformers)
+			self.excluded_dirs = parent.excluded_dirs # it's never changed in place
 			self.context = parent.context
+		self.auto_index = None # input extension: [(name, auto preset)], built on demand
 		self.output = []
 		self.need_eval = False
 		self.filename = ""
@@ -58,28 +136,89 @@ class Engine:
 
 	# load manifest
 	def load(self, filename, logo = True):
+		self.context.fox_files.append(filename)
 		self.filename = filename
 		self.rel_path = rel_dir(filename)
 		if logo:
 			self.output.append("# generated with love by buildfox from %s" % filename)
 		self.write_rel_path()
-		parse(self, filename)
+		parse(self, filename, cache = self.context.cache)
+
+	# load manifest and stream output to out_filename while it's generated,
+	# out_filename is only replaced if manifest was loaded without errors
+	# if generator_command is provided then ninja will run it to generate out_filename again
+	def generate(self, filename, out_filename, logo = True, generator_command = None):
+		self.output = OutputFile(out_filename, self.output)
+		try:
+			self.load(filename, logo)
+			if generator_command:
+				self.write_generator(generator_command, out_filename)
+		except:
+			self.output.discard()
+			raise
+		self.output.close()
+		self.context.ninja_files.append(out_filename)
 
 	# load core definitions
 	def load_core(self, fox_core):
 		self.filename = "fox_core.fox"
 		self.rel_path = ""
 		self.write_rel_path()
-		parse(self, self.filename, text = fox_core)
+		cache = self.context.cache
+		if cache is None:
+			parse(self, self.filename, text = fox_core)
+			return
 
-	# return output text
+		# core only depends on state before it, like toolset and variation,
+		# so we can cache whole engine state after core is loaded
+		key = cache.key(fox_core, repr(self.snapshot()))
+		state = cache.load("core", key)
+		if state is None:
+			parse(self, self.filename, text = fox_core, cache = cache)
+			cache.save("core", key, self.snapshot())
+		else:
+			self.restore(state)
+
+	# return engine state that can be stored with marshal, dicts are stored as lists to keep their order,
+	# core doesn't have build commands so context is not part of the state
+	def snapshot(self):
+		return (
+			list(self.variables.items()),
+			list(self.auto_presets.items()),
+			self.rel_path,
+			list(self.rules.items()),
+			list(self.transformers.items()),
+			sorted(self.excluded_dirs),
+			list(self.output),
+			self.filename,
+			self.rules_were_added,
+		)
+
+	# restore state from snapshot, snapshot itself is not changed
+	def restore(self, state):
+		self.variables = dict(state[0])
+		self.versions = dict((name, next(variable_versions)) for name in self.variables)
+		self.auto_presets = dict(state[1])
+		self.auto_index = None
+		self.rel_path = state[2]
+		self.rules = dict(state[3])
+		self.transformers = dict(state[4])
+		self.excluded_dirs = frozenset(state[5])
+		self.output = list(state[6])
+		self.filename = state[7]
+		self.rules_were_added = state[8]
+
+	# evaluate AST from lib_parser.load_ast, same AST can be evaluated any number of times
+	def execute(self, ast):
+		replay(self, ast)
+
+	# return output text, only available if output wasn't streamed with generate
 	def text(self):
 		return "\n".join(self.output) + "\n"
 
 	def save(self, filename):
 		if filename:
-			with open(filename, "w") as f:
-				f.write(self.text())
+			OutputFile(filename, self.output).close()
 		else:
 			print(self.text())
 
@@ -87,61 +226,111 @@ class Engine:
 		if text == None:
 			return None
 		elif isinstance(text, string_types):
-			raw = text.startswith("r\"")
-
-			# first remove escaped sequences
-			if not raw:
-				def repl_escaped(matchobj):
-					return matchobj.group(1)
-				text = re_base_escaped.sub(repl_escaped, text)
-
-			# then do variable substitution
-			def repl(matchobj):
-				prefix = matchobj.group(1)
-				name = matchobj.group(3)
-				if matchobj.group(2):
-					default = "${%s}" % name
-				else:
-					default = "$%s" % name
-				if name in local_scope:
-					return prefix + local_scope.get(name, default)
-				else:
-					return prefix + self.variables.get(name, default)
-
-			if "$" in text:
-				text = re_var.sub(repl, text)
-
-				# and finally fix escaped $ but escaped variables
-				if not raw:
-					text = text.replace("$$", "$")
-
-			return text
+			if "$" not in text:
+				return text
+
+			# result only depends on variables used in text, so it's reused
+			# while they have same versions or same values in local scope
+			cached = self.context.eval_cache.get(text)
+			if cached and cached[1] == self.eval_state(cached[0], local_scope):
+				return cached[2]
+
+			names = []
+			result = self.eval_text(text, local_scope, names)
+			self.context.eval_cache[text] = (names, self.eval_state(names, local_scope), result)
+			return result
 		else:
 			return [self.eval(str, local_scope) for str in text]
 
-	# evaluate and find files
+	# return versions of global variables and values of local variables
+	def eval_state(self, names, local_scope):
+		if local_scope:
+			return tuple([("", local_scope[name]) if name in local_scope else self.versions.get(name) for name in names])
+		else:
+			return tuple(map(self.versions.get, names))
+
+	# evaluate text, names of all used variables are appended to names list
+	def eval_text(self, text, local_scope, names):
+		raw = text.startswith("r\"")
+
+		# first remove escaped sequences
+		if not raw:
+			def repl_escaped(matchobj):
+				return matchobj.group(1)
+			text = re_base_escaped.sub(repl_escaped, text)
+
+		# then do variable substitution
+		def repl(matchobj):
+			prefix = matchobj.group(1)
+			name = matchobj.group(3)
+			names.append(name)
+			if matchobj.group(2):
+				default = "${%s}" % name
+			else:
+				default = "$%s" % name
+			if name in local_scope:
+				return prefix + local_scope.get(name, default)
+			else:
+				return prefix + self.variables.get(name, default)
+
+		if "$" in text:
+			text = re_var.sub(repl, text)
+
+			# and finally fix escaped $ but escaped variables
+			if not raw:
+				text = text.replace("$$", "$")
+
+		return text
+
+	# evaluate and find files, files of same inputs are found only once until files are generated in their folders,
+	# inputs without wildcards or regexes are not cached because they don't look for files
 	def eval_find_files(self, input, output = None):
-		return find_files(self.eval_path_transform(input),
+		inputs = self.eval_path_transform(input)
+		if not inputs or all(wildcard_regex(input, False, set()) is None for input in inputs):
+			found = glob_inputs(inputs, rel_path = self.rel_path, dir_cache = self.context.dir_cache, paths = self.context.paths)
+		else:
+			key = (tuple(inputs) if isinstance(inputs, list) else inputs, self.rel_path, self.excluded_dirs)
+			found = self.context.glob_cache.get(key)
+			if found is None:
+				folders = set()
+				recursive_folders = set()
+				found = glob_inputs(inputs,
+									rel_path = self.rel_path,
+									generated = self.context.generated,
+									excluded_dirs = self.excluded_dirs,
+									dir_cache = self.context.dir_cache,
+									paths = self.context.paths,
+									generated_tree = self.context.generated_tree,
+									folders = folders,
+									recursive_folders = recursive_folders)
+				self.context.glob_cache[key] = found
+				for folder in folders:
+					self.context.glob_deps[folder].add(key)
+				for folder in recursive_folders:
+					self.context.glob_recursive_deps[folder].add(key)
+		return find_files(inputs,
 						  self.eval_path_transform(output),
 						  rel_path = self.rel_path,
-						  generated = self.context.generated,
-						  excluded_dirs = self.excluded_dirs)
+						  paths = self.context.paths,
+						  found = found)
 
 	def add_files(self, files):
 		if not files:
 			return
 		for file in files:
-			dir, name = os.path.split(file)
-			dir = dir + "/" if dir else "./"
+			dir, name = self.context.paths.split(file)
 			self.context.all_files[dir].add(name)
 
 	def add_generated_files(self, files):
 		if not files:
 			return
 		for file in files:
-			dir = os.path.dirname(file)
-			dir = dir + "/" if dir else "./"
-			name = os.path.basename(file)
+			dir, name = self.context.paths.split(file)
+			if dir not in self.context.generated:
+				add_generated_folder(self.context.generated_tree, dir)
+				for folder in list(self.context.glob_recursive_deps.keys()):
+					if folder == "./" or dir.startswith(folder):
+						self.forget_globs(self.context.glob_recursive_deps.pop(folder))
 			if name in self.context.generated[dir]:
 				raise ValueError("two or more commands generate target '%s' in '%s' (%s:%i), each target must be generated only once" % (
 					file,
@@ -151,35 +340,23 @@ class Engine:
 				))
 			else:
 				self.context.generated[dir].add(name)
+				self.forget_globs(self.context.glob_deps.pop(dir, ()))
+
+	# drop found files of globs, so they are found again
+	def forget_globs(self, keys):
+		for key in keys:
+			self.context.glob_cache.pop(key, None)
 
 	def eval_auto(self, inputs, outputs):
-		for rule_name, auto in self.auto_presets.items(): # name: (inputs, outputs, assigns)
+		# in multiline mode $ also matches before newline, so presets can't be picked by extension of such names
+		ext = file_extension(inputs[0]) if inputs and "\n" not in inputs[0] else None
+		for rule_name, assigns, input_matches, output_matches in self.auto_candidates(ext):
 			# check if all inputs match required auto inputs
-			for auto_input in auto[0]:
-				regex = wildcard_regex(auto_input)
-				if regex:
-					re_regex = re.compile(regex)
-					match = all(re_regex.match(input) for input in inputs)
-				else:
-					match = all(input == auto_input for input in inputs)
-				if not match:
-					break
-			if not match:
-				continue
-			# check if all outputs match required auto outputs
-			for auto_output in auto[1]:
-				regex = wildcard_regex(auto_output)
-				if regex:
-					re_regex = re.compile(regex)
-					match = all(re_regex.match(output) for output in outputs)
-				else:
-					match = all(output == auto_output for output in outputs)
-				if not match:
-					break
-			if not match:
-				continue
-			# if everything match - return rule name and variables
-			return rule_name, auto[2]
+			# and if all outputs match required auto outputs
+			if all(match(input) for match in input_matches for input in inputs) and \
+				all(match(output) for match in output_matches for output in outputs):
+				# if everything match - return rule name and variables
+				return rule_name, assigns
 		# if no rule found then just fail and optionally return None 
 		raise ValueError(("unable to deduce auto rule in '%s', " +
 			"please check if your file extensions are supported by current toolchain (%s:%i) " +
@@ -192,11 +369,50 @@ class Engine:
 		))
 		return None, None
 
+	# return auto presets in their order that may match inputs with provided extension,
+	# presets that can't be indexed by extension are always returned,
+	# each candidate is (rule name, assigns, input match functions, output match functions)
+	def auto_candidates(self, ext):
+		if self.auto_index is None:
+			self.auto_index = {}
+		candidates = self.auto_index.get(ext)
+		if candidates is None:
+			candidates = [(
+					rule_name,
+					auto[2],
+					[self.auto_pattern(auto_input)[0] for auto_input in auto[0]],
+					[self.auto_pattern(auto_output)[0] for auto_output in auto[1]]
+				) for rule_name, auto in self.auto_presets.items() # name: (inputs, outputs, assigns)
+					if ext is None or all(self.auto_may_match(auto_input, ext) for auto_input in auto[0])]
+			self.auto_index[ext] = candidates
+		return candidates
+
+	def auto_may_match(self, pattern, ext):
+		match, extensions, ignore_case = self.auto_pattern(pattern)
+		if extensions is None:
+			return True
+		elif ignore_case:
+			return ext.lower() in extensions or not re_ascii_only.match(ext)
+		else:
+			return ext in extensions
+
+	# return (match function, extensions, ignore case) of auto pattern, patterns are compiled only once
+	def auto_pattern(self, pattern):
+		compiled = self.context.auto_patterns.get(pattern)
+		if compiled is None:
+			regex = wildcard_regex(pattern)
+			if regex:
+				compiled = (compile_regex(regex).match,) + (regex_extensions(regex) or (None, False))
+			else:
+				compiled = (lambda value: value == pattern, set([file_extension(pattern)]), False)
+			self.context.auto_patterns[pattern] = compiled
+		return compiled
+
 	def eval_filter(self, name, regex_or_value):
 		value = self.variables.get(name, "")
 		regex = wildcard_regex(regex_or_value)
 		if regex:
-			return re.match(regex, value)
+			return compile_regex(regex).match(value)
 		else:
 			return regex_or_value == value
 
@@ -235,21 +451,25 @@ class Engine:
 			return [self.eval_path_transform(str) for str in value]
 
 	def eval_transform(self, name, values, eval = True, local_scope = {}):
-		transformer = self.transformers.get(name)
-		if transformer is None:
+		template = self.transformers.get(name)
+		if template is None:
 			return self.eval(values, local_scope) if eval else values
 
 		# transform one value with transformer template
 		def transform_one(value):
 			if not value:
 				return ""
-			split = os.path.split(value)
-			value_split = {
-				"param": value,
-				"path": (split[0] + "/" if split[0] else ""),
-				"file": split[1]
-			}
-			value = re_subst.sub(lambda mathobj: value_split.get(mathobj.group(1)), transformer)
+			parts = list(template)
+			if len(parts) > 1:
+				split = os.path.split(value)
+				value_split = {
+					"param": value,
+					"path": (split[0] + "/" if split[0] else ""),
+					"file": split[1]
+				}
+				for i in range(1, len(parts), 2):
+					parts[i] = value_split[parts[i]]
+			value = "".join(parts)
 			# TODO not sure what effects eval = False give here
 			return self.eval(value, local_scope) if eval else value
 
@@ -271,6 +491,31 @@ class Engine:
 			self.output.append("  %s = %s" % (name, self.to_esc(value, simple = True)))
 			local_scope[name] = value
 
+	# ninja runs buildfox again if any fox file changed or files were added to or removed from scanned folders,
+	# restat is needed because ninja files are not touched if their text is same
+	def write_generator(self, command, out_filename):
+		normpath = lambda path: os.path.normpath(path).replace("\\", "/")
+		# ninja fails on missing inputs, so nearest existing parent is used for missing folder,
+		# its mtime changes when missing folder is created
+		folders = []
+		for path, listing in list(self.context.dir_cache.listings.items()):
+			while listing is None:
+				parent = os.path.dirname(os.path.normpath(path)) or "."
+				if parent == path:
+					break
+				path = parent
+				listing = self.context.dir_cache.list_dir(path)
+			if listing is not None:
+				folders.append(path)
+		inputs = sorted(set(map(normpath, self.context.fox_files))) + sorted(set(map(normpath, folders)))
+		self.output.append("")
+		self.output.append("rule buildfox")
+		self.output.append("  command = " + self.to_esc(command, simple = True))
+		self.output.append("  description = buildfox $out")
+		self.output.append("  generator = 1")
+		self.output.append("  restat = 1")
+		self.output.append("build %s: buildfox | %s" % (self.to_esc(out_filename), " ".join(self.to_esc(inputs))))
+
 	def write_rel_path(self):
 		self.on_assign(("rel_path", self.rel_path, "="))
 
@@ -345,9 +590,9 @@ class Engine:
 		local_scope = {}
 		def add_target_info(name, targets):
 			for index, file in enumerate(targets):
-				split = os.path.split(file)
-				local_scope["%s_path_%i" % (name, index)] = split[0]
-				local_scope["%s_name_%i" % (name, index)] = split[1]
+				dir, file_name = self.context.paths.split(file)
+				local_scope["%s_path_%i" % (name, index)] = dir[:-1] if dir != "./" else ""
+				local_scope["%s_name_%i" % (name, index)] = file_name
 		add_target_info("inputs_explicit", inputs_explicit)
 		add_target_info("inputs_implicit", inputs_implicit)
 		add_target_info("inputs_order", inputs_order)
@@ -446,6 +691,9 @@ class Engine:
 		name = self.eval(obj[1])
 		inputs = self.eval(obj[2]) # this shouldn't be find_files !
 		self.auto_presets[name] = (inputs, outputs, assigns)
+		self.auto_index = None
+		for pattern in inputs + outputs:
+			self.auto_pattern(pattern)
 
 	def on_print(self, obj):
 		print(self.eval(obj))
@@ -461,15 +709,16 @@ class Engine:
 			# Checking the version immediately to fail fast.
 			version_check(value)
 		elif name == "excluded_dirs":
-			self.excluded_dirs = set(re_non_escaped_space.split(value))
+			self.excluded_dirs = frozenset(re_non_escaped_space.split(value))
 
 		self.variables[name] = value
+		self.versions[name] = next(variable_versions)
 		self.output.append("%s = %s" % (name, self.to_esc(value, simple = True)))
 
 	def on_transform(self, obj):
 		target = self.eval(obj[0])
 		pattern = obj[1] # do not eval it here
-		self.transformers[target] = pattern
+		self.transformers[target] = transformer_template(pattern)
 
 	def on_include(self, obj):
 		paths = self.eval_find_files([obj])
@@ -477,21 +726,30 @@ class Engine:
 			old_rel_path = self.rel_path
 			self.rel_path = rel_dir(path)
 			self.write_rel_path()
-			parse(self, path)
+			self.context.fox_files.append(path)
+			parse(self, path, cache = self.context.cache)
 			self.rel_path = old_rel_path
 
 	def on_subninja(self, obj):
 		paths = self.eval_find_files([obj])
 		for path in paths:
-			gen_filename = "__gen_%i_%s.ninja" % (
-				self.context.subninja_num,
-				re_alphanumeric.sub("", os.path.splitext(os.path.basename(path))[0])
+			# name depends only on path of fox file, so adding subfox files doesn't rename other files
+			path_id = path.replace("\\", "/")
+			gen_name = "__gen_%s_%s" % (
+				re_alphanumeric.sub("", os.path.splitext(os.path.basename(path))[0]),
+				hashlib.sha1(path_id if isinstance(path_id, bytes) else path_id.encode("utf-8")).hexdigest()[:8]
+			)
+			# same file can be included many times with different variables
+			count = self.context.subninja_names.get(gen_name, 0)
+			self.context.subninja_names[gen_name] = count + 1
+			gen_filename = "%s%s%s.ninja" % (
+				gen_name,
+				"_%i" % count if count else "",
+				"_" + self.context.variant if self.context.variant else ""
 			)
-			self.context.subninja_num += 1
 
 			engine = Engine(self)
-			engine.load(path)
-			engine.save(gen_filename)
+			engine.generate(path, gen_filename)
 
 			# we depend on scoped rules so let's enforce 1.6 version if you use rules
 			if engine.rules_were_added:
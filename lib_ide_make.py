@@ -1,8 +1,6 @@
 # BuildFox ninja generator
 
-import os, sys
-
-def gen_make(buildfox_name, cmd_env, ninja_gen_mode, filename = "Makefile"):
+def gen_make(cmd_env, ninja_gen_mode, filename = "Makefile"):
 	text = """# generated by BuildFox
 %s
 compile:
@@ -11,24 +9,13 @@ clean:
 	ninja -t clean
 """
 
-	if ninja_gen_mode:
-		all = "all: compile"
+	# ninja files are generated again by ninja itself when needed
+	if cmd_env and not ninja_gen_mode:
+		all = "all: set_env compile\n"
+		all += "set_env:\n"
+		all += "\t%s" % cmd_env.replace("#", "\\#").replace("$", "$$")
 	else:
-		if cmd_env:
-			all = "all: set_env configure compile\n"
-			all += "set_env:\n"
-			all += "\t%s\n" % cmd_env.replace("#", "\\#").replace("$", "$$")
-		else:
-			all = "all: configure compile\n"
-
-		bf_exec = os.path.abspath(sys.argv[0])
-		if bf_exec.endswith(".py"):
-			bf_exec = sys.executable + " " + bf_exec
-		bf_cmd = bf_exec + " --just-generate"
-		if buildfox_name != "build.fox":
-			bf_cmd += " -i " + buildfox_name
-		all += "configure:\n"
-		all += "\t%s" % bf_cmd
+		all = "all: compile"
 
 	with open(filename, "w") as f:
 		f.write(text % all)
@@ -50,7 +50,7 @@ xcode_reference_prj = r"""
 """
 
 def gen_xcode(all_files, includedirs, prj_name, buildfox_name, cmd_env, ninja_gen_mode):
-	gen_make(buildfox_name, cmd_env, ninja_gen_mode)
+	gen_make(cmd_env, ninja_gen_mode)
 
 	all_files = cxx_findfiles(all_files)
 	includedirs = [".", "build/bin_debug"] + includedirs
@@ -1,24 +1,134 @@
 # BuildFox ninja generator
 
+import os
 import re
+import bisect
 
 # parser regexes
-re_newline_escaped = re.compile("\$+$")
 re_identifier = re.compile("[a-zA-Z0-9\${}_.-]+")
 re_path = re.compile(r"(r?\"(?:\\\"|.)*?\")|((\$\||\$ |\$:|[^ :|\n])+)")
+re_whitespace = re.compile(r"\s*")
+
+# odd number of $ in the end escapes newline,
+# even number of them are just escaped $ combinations
+def newline_escaped(line):
+	return line.endswith("$") and (len(line) - len(line.rstrip("$"))) % 2 == 1
+
+# files bigger than this are not recorded into parse cache, so they are never fully kept in memory
+max_cached_file_size = 16 * 1024 * 1024
+
+# return lines from file in batches, same as f.read().splitlines() would do
+def read_lines(filename):
+	with open(filename, "r") as f:
+		while True:
+			lines = f.readlines(1 << 16) # readlines always stops at the end of line
+			if not lines:
+				break
+			yield "".join(lines).splitlines()
+
+# lazy source of lines with lookahead buffer,
+# only lines that parser may roll back to are kept in memory
+class LineSource:
+	def __init__(self, batches):
+		self.batches = iter(batches)
+		self.buffer = []
+		self.offset = 0 # index of first line in buffer
+
+	# return line by index or None if there are no more lines
+	def get(self, index):
+		index -= self.offset
+		while index >= len(self.buffer):
+			batch = next(self.batches, None)
+			if batch is None:
+				return None
+			self.buffer.extend(batch)
+		return self.buffer[index]
+
+	# forget lines before index, buffer is trimmed in big steps so calling this often is cheap
+	def release(self, index):
+		if index - self.offset >= 4096:
+			# index may point past the buffer after skipping a block, drop whole batches then
+			while index - self.offset > len(self.buffer):
+				batch = next(self.batches, None)
+				if batch is None:
+					break
+				self.offset += len(self.buffer)
+				self.buffer = batch
+			del self.buffer[:index - self.offset]
+			self.offset = index
+
+# return (line index, index of line after it, line) for each line, escaped newlines are joined
+def read_logical_lines(batches):
+	line_end = 0
+	escaped = None # if newline is escaped then this is beginning of current line
+	for batch in batches:
+		for line in batch:
+			line_end += 1
+			# last $ is stripped because it escapes newline
+			if newline_escaped(line):
+				if escaped is None:
+					line_i = line_end - 1
+					escaped = line[:-1]
+				else:
+					escaped += line[:-1]
+			elif escaped is None:
+				yield line_end - 1, line_end, line
+			else:
+				yield line_i, line_end, escaped + line
+				escaped = None
+	if escaped is not None:
+		yield line_i, line_end, escaped
+
+# return dict of line index -> index of line after end of nested block for filter lines,
+# block ends before first next line that has at most one more whitespace than filter line,
+# empty lines and comments after the block belong to the next line unless block ends file
+def find_block_ends(batches):
+	ends = {}
+	stack = [] # (line index, end index, whitespace) of filters which blocks are not finished yet
+	ws_ref = -1 # lines with this or less whitespace finish block on top of stack
+	last_end = 0 # end index of last line that is not empty or comment
+	line_end = 0
+	for line_i, line_end, line in read_logical_lines(batches):
+		stripped = line.lstrip()
+		if (not stripped) or (stripped[0] == "#"):
+			continue
+		ws_len = len(line) - len(stripped)
+		whitespace = ws_len + 3 * line.count("\t", 0, ws_len) if ws_len else 0
+		while ws_ref >= whitespace:
+			ref_i, ref_end, ref_whitespace = stack.pop()
+			if last_end != ref_end:
+				ends[ref_i] = last_end
+			ws_ref = stack[-1][2] + 1 if stack else -1
+		if stripped.startswith("filter"):
+			stack.append((line_i, line_end, whitespace))
+			ws_ref = whitespace + 1
+		last_end = line_end
+
+	# blocks in the end of file also own empty lines and comments after them
+	for ref_i, ref_end, ref_whitespace in stack:
+		if line_end != ref_end:
+			ends[ref_i] = line_end
+	return ends
 
 class Parser:
-	def __init__(self, engine, filename, text = None):
+	# if events list is provided then parser records events instead of passing them to engine
+	def __init__(self, engine, filename, text = None, events = None):
 		self.engine = engine
 		self.filename = filename
+		self.events = events
 		self.whitespace_nested = None
 		self.comments = []
 		self.empty_lines = 0
-		if text:
-			self.lines = text.splitlines()
+		self.text = text
+		self.lines = LineSource(self.read_batches())
+		self.block_ends = None # found on first disabled filter
+
+	# return lines in batches, file is read again on every call
+	def read_batches(self):
+		if self.text:
+			return [self.text.splitlines()]
 		else:
-			with open(self.filename, "r") as f:
-				self.lines = f.read().splitlines()
+			return read_lines(self.filename)
 
 	# parse everything
 	def parse(self):
@@ -35,67 +145,70 @@ class Parser:
 
 	def parse_line(self):
 		self.command = self.read_identifier()
+		self.command_line = self.line
+		self.command_line_num = self.line_num
 
-		self.engine.current_line = self.line
-		self.engine.current_line_i = self.line_num
-
-		if self.empty_lines:
-			self.engine.on_empty_lines(self.empty_lines)
-			self.empty_lines = 0
-
-		if len(self.comments):
-			for comment in self.comments:
-				self.engine.on_comment(comment)
-			self.comments = []
-
-		if self.command == "rule":
-			obj = self.read_rule()
-			assigns = self.read_nested_assigns()
-			self.engine.on_rule(obj, assigns)
-
-		elif self.command == "build":
-			obj = self.read_build()
-			assigns = self.read_nested_assigns()
-			self.engine.on_build(obj, assigns)
-
-		elif self.command == "default":
-			obj = self.read_default()
-			self.engine.on_default(obj)
-
-		elif self.command == "pool":
-			obj = self.read_pool()
-			assigns = self.read_nested_assigns()
-			self.engine.on_pool(obj, assigns)
-
-		elif self.command == "include":
-			obj = self.read_include()
-			self.engine.on_include(obj)
-
-		elif self.command == "subninja" or self.command == "subfox":
-			obj = self.read_subninja()
-			self.engine.on_subninja(obj)
+		if self.events is not None:
+			self.record_pending(self.events)
+		else:
+			self.engine.current_line = self.line
+			self.engine.current_line_i = self.line_num
+
+			if self.empty_lines:
+				self.engine.on_empty_lines(self.empty_lines)
+				self.empty_lines = 0
+
+			if len(self.comments):
+				for comment in self.comments:
+					self.engine.on_comment(comment)
+				self.comments = []
+
+		statement = self.statements.get(self.command)
+		if statement:
+			callback, read, nested = statement
+			obj = read(self)
+			if nested:
+				self.emit(callback, obj, self.read_nested_assigns())
+			else:
+				self.emit(callback, obj)
 
 		elif self.command == "filter":
 			obj = self.read_filter()
-			need_to_parse = self.engine.filter(obj)
-			self.process_filtered(need_to_parse)
+			if self.events is not None:
+				self.events.append(("#filter", self.command_line, self.command_line_num, obj, self.record_filtered()))
+			else:
+				need_to_parse = self.engine.filter(obj)
+				self.process_filtered(need_to_parse)
 
-		elif self.command == "auto":
-			obj = self.read_auto()
-			assigns = self.read_nested_assigns()
-			self.engine.on_auto(obj, assigns)
+		else:
+			obj = self.read_assign()
+			self.emit("on_assign", obj)
 
-		elif self.command == "print":
-			obj = self.read_print()
-			self.engine.on_print(obj)
+	# pass object to engine callback or record it
+	def emit(self, callback, *args):
+		if self.events is not None:
+			self.events.append((callback, self.command_line, self.command_line_num) + args)
+		else:
+			getattr(self.engine, callback)(*args)
 
-		elif self.command == "transformer":
-			obj = self.read_transformer()
-			self.engine.on_transform(obj)
+	# record pending empty lines and comments, they will be passed to engine before next command
+	def record_pending(self, events):
+		if self.empty_lines or self.comments:
+			events.append(("#pending", self.empty_lines, tuple(self.comments)))
+			self.empty_lines = 0
+			self.comments = []
 
+	# record filter body as it would be enabled, engine will decide about it on replay
+	def record_filtered(self, parse_nested_assigns = False):
+		body = []
+		if parse_nested_assigns:
+			self.process_filtered(True, parse_nested_assigns = True, nested_assigns_list = body)
 		else:
-			obj = self.read_assign()
-			self.engine.on_assign(obj)
+			events, self.events = self.events, body
+			self.process_filtered(True)
+			self.events = events
+		self.record_pending(body)
+		return body
 
 	def read_rule(self):
 		rule = self.read_identifier()
@@ -111,38 +224,38 @@ class Parser:
 		inputs_order = []
 
 		# read targets explicit
-		while self.line_stripped[0] not in ["|", ":"]:
+		while self.line[self.pos] not in ["|", ":"]:
 			targets_explicit.append(self.read_path())
 			self.expect_token()
 
 		# read targets implicit
-		if self.line_stripped[0] == "|":
-			self.line_stripped = self.line_stripped[1:].strip()
+		if self.line[self.pos] == "|":
+			self.advance(1)
 			self.expect_token()
-			while self.line_stripped[0] != ":":
+			while self.line[self.pos] != ":":
 				targets_implicit.append(self.read_path())
 				self.expect_token()
 
 		# read rule name
 		self.expect_token(":")
-		self.line_stripped = self.line_stripped[1:].strip()
+		self.advance(1)
 		rule = self.read_identifier()
 
-		if self.line_stripped:
+		if self.pos < self.end:
 			# read inputs explicit
-			while self.line_stripped and (self.line_stripped[0] != "|"):
+			while (self.pos < self.end) and (self.line[self.pos] != "|"):
 				inputs_explicit.append(self.read_path())
 
 			# read inputs implicit
-			if (len(self.line_stripped) >= 2) and (self.line_stripped[0] == "|") and (self.line_stripped[1] != "|"):
-				self.line_stripped = self.line_stripped[1:].strip()
-				while self.line_stripped and (self.line_stripped[0] != "|"):
+			if (self.end - self.pos >= 2) and (self.line[self.pos] == "|") and (self.line[self.pos + 1] != "|"):
+				self.advance(1)
+				while (self.pos < self.end) and (self.line[self.pos] != "|"):
 					inputs_implicit.append(self.read_path())
 
 			# read inputs order
-			if self.line_stripped and (self.line_stripped[0] == "|") and (self.line_stripped[1] == "|"):
-				self.line_stripped = self.line_stripped[2:].strip()
-				while self.line_stripped:
+			if self.line.startswith("||", self.pos, self.end):
+				self.advance(2)
+				while self.pos < self.end:
 					inputs_order.append(self.read_path())
 
 		self.read_eol()
@@ -158,7 +271,7 @@ class Parser:
 	def read_default(self):
 		self.expect_token()
 		paths = []
-		while self.line_stripped:
+		while self.pos < self.end:
 			paths.append(self.read_path())
 		self.read_eol()
 		return paths
@@ -182,31 +295,44 @@ class Parser:
 	def read_filter(self):
 		self.expect_token()
 		filters = []
-		while self.line_stripped:
+		while self.pos < self.end:
 			name = self.read_identifier()
 			self.expect_token(":")
-			self.line_stripped = self.line_stripped[1:].strip()
+			self.advance(1)
 			value = self.read_path()
 			filters.append((name, value))
 		self.read_eol()
 		return filters
 
 	def process_filtered(self, need_to_parse, parse_nested_assigns = False, nested_assigns_list = None):
+		if not need_to_parse: # if we know that filter is disabled, no need to parse then
+			self.skip_block()
+			return
+
 		ws_ref = self.whitespace
-		while self.line_i < len(self.lines):
+		while True:
 			start_i = self.line_i
-			if not self.next_line(preserve_comments = need_to_parse):
+			comments_len = len(self.comments)
+			empty_lines = self.empty_lines
+			if not self.next_line():
 				break
 			# if offset is less then two spaces
 			# then we stop processing
 			if self.whitespace <= ws_ref + 1:
 				self.line_i = start_i
+				self.comments = self.comments[:comments_len]
+				self.empty_lines = empty_lines
 				break
-			if need_to_parse: # if we know that filter is disabled, no need to parse then
-				if parse_nested_assigns:
-					self.read_nested_assign(nested_assigns_list)
-				else:
-					self.parse_line()
+			if parse_nested_assigns:
+				self.read_nested_assign(nested_assigns_list)
+			else:
+				self.parse_line()
+
+	# jump over nested block of current line, block ends are found in one pass over the file
+	def skip_block(self):
+		if self.block_ends is None:
+			self.block_ends = find_block_ends(self.read_batches())
+		self.line_i = self.block_ends.get(self.line_num - 1, self.line_i)
 
 	def read_auto(self):
 		self.expect_token()
@@ -214,18 +340,18 @@ class Parser:
 		inputs = []
 
 		# read targets
-		while self.line_stripped[0] != ":":
+		while self.line[self.pos] != ":":
 			targets.append(self.read_path())
 			self.expect_token()
 
 		# read rule name
 		self.expect_token(":")
-		self.line_stripped = self.line_stripped[1:].strip()
+		self.advance(1)
 		rule = self.read_identifier()
 
 		# read inputs
 		self.expect_token()
-		while self.line_stripped:
+		while self.pos < self.end:
 			inputs.append(self.read_path())
 		self.read_eol()
 		return (targets, rule, inputs)
@@ -235,16 +361,17 @@ class Parser:
 
 		name = self.read_identifier()
 		self.expect_token(":")
-		pattern = self.line_stripped = self.line_stripped[1:].strip()
+		self.advance(1)
+		pattern = self.read_rest()
 
 		return (name, pattern)
 
 	def read_print(self):
-		return self.line_stripped.strip()
+		return self.read_rest()
 
 	def read_assign(self):
 		op = self.read_assign_op()
-		value = self.line_stripped
+		value = self.read_rest()
 		return (self.command, value, op)
 
 	def read_nested_assigns(self):
@@ -255,80 +382,94 @@ class Parser:
 
 	def read_nested_assign(self, assign_list):
 		name = self.read_identifier()
-		if name == "filter" and self.line_stripped and (not self.line_stripped.startswith(("=", "+=", "-="))):
+		if name == "filter" and (self.pos < self.end) and (not self.line.startswith(("=", "+=", "-="), self.pos, self.end)):
 			obj = self.read_filter()
-			need_to_parse = self.engine.filter(obj, nested_assigns = assign_list)
-			self.process_filtered(need_to_parse, parse_nested_assigns = True, nested_assigns_list = assign_list)
+			if self.events is not None:
+				self.record_pending(assign_list)
+				assign_list.append(("#filter", obj, self.record_filtered(parse_nested_assigns = True)))
+			else:
+				need_to_parse = self.engine.filter(obj, nested_assigns = assign_list)
+				self.process_filtered(need_to_parse, parse_nested_assigns = True, nested_assigns_list = assign_list)
 		else:
 			op = self.read_assign_op()
-			value = self.line_stripped
+			value = self.read_rest()
 			assign_list.append((name, value, op))
 
 	def read_assign_op(self):
 		# TODO make it nicer
 		self.expect_token(("=", "+=", "-="))
-		if self.line_stripped[0] == "+":
+		if self.line[self.pos] == "+":
 			# don't strip whitespace here
 			# because we want to preserve it so we can process it correctly
-			self.line_stripped = self.line_stripped[2:]
+			self.pos += 2
 			return "+="
-		elif self.line_stripped[0] == "-":
+		elif self.line[self.pos] == "-":
 			# don't strip whitespace here
 			# because we want to preserve it so we can process it correctly
-			self.line_stripped = self.line_stripped[2:]
+			self.pos += 2
 			return "-="
 		else:
-			self.line_stripped = self.line_stripped[1:].strip()
+			self.advance(1)
 			return "="
 
 	def read_identifier(self):
-		identifier = re_identifier.match(self.line_stripped)
+		identifier = re_identifier.match(self.line, self.pos, self.end)
 		if not identifier:
 			raise ValueError("expected token 'identifier' in '%s' (%s:%i)" % (
-				self.line_stripped,
+				self.line[self.pos:self.end],
 				self.filename,
-				self.line_num
+				self.cursor_line_num()
 			))
-		self.line_stripped = self.line_stripped[identifier.span()[1]:].strip()
+		self.advance(identifier.end() - self.pos)
 		return identifier.group()
 
 	def expect_token(self, name = ""):
 		if name:
-			if (not self.line_stripped) or (not self.line_stripped.startswith(name)):
+			if not self.line.startswith(name, self.pos, self.end):
 				raise ValueError("expected token '%s' in '%s' (%s:%i)" % (
 					str(name),
-					self.line_stripped,
+					self.line[self.pos:self.end],
 					self.filename,
-					self.line_num
+					self.cursor_line_num()
 				))
 		else:
-			if not self.line_stripped:
+			if self.pos >= self.end:
 				raise ValueError("expected token(s) in '%s' (%s:%i)" % (
-					self.line_stripped,
+					self.line[self.pos:self.end],
 					self.filename,
-					self.line_num
+					self.cursor_line_num()
 				))
 
 	def read_path(self):
-		path = re_path.match(self.line_stripped)
+		path = re_path.match(self.line, self.pos, self.end)
 		if not path:
 			raise ValueError("expected token 'path' in '%s' (%s:%i)" % (
-				self.line_stripped,
+				self.line[self.pos:self.end],
 				self.filename,
-				self.line_num
+				self.cursor_line_num()
 			))
-		self.line_stripped = self.line_stripped[path.span()[1]:].strip()
+		self.advance(path.end() - self.pos)
 		return path.group()
 
+	# return everything left in current line and move cursor to the end of it
+	def read_rest(self):
+		rest = self.line[self.pos:self.end]
+		self.pos = self.end
+		return rest
+
 	def read_eol(self):
-		if self.line_stripped:
+		if self.pos < self.end:
 			raise ValueError("unexpected token '%s' in '%s' (%s:%i)" % (
-				self.line_stripped,
+				self.line[self.pos:self.end],
 				self.line,
 				self.filename,
-				self.line_num
+				self.cursor_line_num()
 			))
 
+	# move cursor forward and skip whitespace after it
+	def advance(self, offset):
+		self.pos = re_whitespace.match(self.line, self.pos + offset, self.end).end()
+
 	# try to read next nested line, roll-back if not successful
 	def next_nested(self):
 		start_i = self.line_i
@@ -357,63 +498,171 @@ class Parser:
 				self.empty_lines = empty_lines
 				return False
 
-	def next_line(self, preserve_comments = True):
-		if self.line_i >= len(self.lines):
-			return False
+	# join lines which newlines are escaped into current line, pieces are joined only once
+	# line_starts keeps offsets of joined lines, so we know real line number of cursor
+	def read_escaped_line(self, physical_line):
+		pieces = []
+		self.line_starts = []
+		offset = 0
+		while True:
+			# last $ is stripped because it escapes newline
+			pieces.append(physical_line[:-1])
+			offset += len(physical_line) - 1
+			physical_line = self.lines.get(self.line_i)
+			if physical_line is None:
+				break
+			self.line_i += 1
+			self.line_starts.append(offset)
+			if not newline_escaped(physical_line):
+				pieces.append(physical_line)
+				break
+		self.line = "".join(pieces)
+
+	# return line number of cursor position
+	def cursor_line_num(self):
+		if self.line_starts:
+			return self.line_num + bisect.bisect_right(self.line_starts, self.pos)
+		else:
+			return self.line_num
+
+	def next_line(self):
+		# we only roll back to start of the line, so previous lines are not needed anymore
+		self.lines.release(self.line_i)
 
-		self.line_stripped = ""
-		while (not self.line_stripped) and (self.line_i < len(self.lines)):
-			self.line = ""
+		self.pos = self.end = 0
+		while self.pos >= self.end:
+			physical_line = self.lines.get(self.line_i)
+			if physical_line is None:
+				break
 			self.line_num = self.line_i + 1
+			self.line_i += 1
 
 			# dealing with escaped newlines
-			newline_escaped = True
-			while newline_escaped and (self.line_i < len(self.lines)):
-				self.line += self.lines[self.line_i]
-				self.line_i += 1
-				if self.line.endswith("$"):
-					# TODO rewrite this
-					newline_escaped = re_newline_escaped.search(self.line)
-					#newline_escaped = None
-					# TODO replace with proper regex !
-					if newline_escaped:
-						l, r = newline_escaped.span()
-						# in some cases we can have $$, $$$$, etc in the end
-						# which are escaped $ combinations, and they don't escape newline
-						if (r - l) % 2:
-							# in case if they do $, $$$, etc, we need to strip last one
-							self.line = self.line[:-1]
-						else:
-							newline_escaped = None
-				else:
-					newline_escaped = None
+			if newline_escaped(physical_line):
+				self.read_escaped_line(physical_line)
+			else:
+				self.line = physical_line
+				self.line_starts = None
 
-			# line is ready for processing
-			self.line_stripped = self.line.strip()
+			# line is ready for processing, cursor points to first non whitespace character
+			self.end = len(self.line.rstrip())
+			self.pos = re_whitespace.match(self.line, 0, self.end).end()
 
 			# skip empty lines
-			if not self.line_stripped:
-				if preserve_comments:
-					self.empty_lines += 1
+			if self.pos >= self.end:
+				self.empty_lines += 1
 				continue
 
 			# strip comment
-			if self.line_stripped and self.line_stripped[0] == "#":
-				if preserve_comments:
-					self.comments.append(self.line_stripped[1:])
-				self.line_stripped = ""
+			if self.line[self.pos] == "#":
+				self.comments.append(self.line[self.pos + 1:self.end])
+				self.pos = self.end = 0
 				continue
 
 		# if we can't skip empty lines, than just return failure
-		if not self.line_stripped:
+		if self.pos >= self.end:
 			return False
 
-		# get whitespace
-		self.whitespace = self.line[:self.line.index(self.line_stripped)]
-		self.whitespace = self.whitespace.replace("\t", "    ")
-		self.whitespace = len(self.whitespace)
+		# get whitespace, tabs are counted as four spaces
+		self.whitespace = self.pos + 3 * self.line.count("\t", 0, self.pos)
 		return True
 
-def parse(engine, filename, text = None):
-	parser = Parser(engine, filename, text)
+	# command: (engine callback, reader, if command has nested assigns)
+	statements = {
+		"rule": ("on_rule", read_rule, True),
+		"build": ("on_build", read_build, True),
+		"default": ("on_default", read_default, False),
+		"pool": ("on_pool", read_pool, True),
+		"include": ("on_include", read_include, False),
+		"subninja": ("on_subninja", read_subninja, False),
+		"subfox": ("on_subninja", read_subninja, False),
+		"auto": ("on_auto", read_auto, True),
+		"print": ("on_print", read_print, False),
+		"transformer": ("on_transform", read_transformer, False),
+	}
+
+# return AST of file as list of events, filtered blocks are recorded with their bodies,
+# AST only contains tuples, lists and strings, so it can be stored with marshal and replayed many times
+# events are tuples of (callback, line, line_num, obj[, nested assigns]),
+# ("#filter", line, line_num, obj, events) or ("#pending", empty_lines, comments),
+# nested assigns may also contain ("#filter", obj, assigns) and ("#pending", ...) entries
+def record(filename, text = None):
+	parser = Parser(None, filename, text, events = [])
 	parser.parse()
+	return parser.events
+
+# pass recorded events to engine
+def replay(engine, events, pending = None):
+	if pending is None:
+		pending = [0, []] # empty lines and comments waiting for next command
+	for event in events:
+		if event[0] == "#pending":
+			pending[0] += event[1]
+			pending[1].extend(event[2])
+			continue
+
+		engine.current_line = event[1]
+		engine.current_line_i = event[2]
+
+		if pending[0]:
+			engine.on_empty_lines(pending[0])
+			pending[0] = 0
+
+		if pending[1]:
+			for comment in pending[1]:
+				engine.on_comment(comment)
+			pending[1] = []
+
+		if event[0] == "#filter":
+			if engine.filter(event[3]):
+				replay(engine, event[4], pending)
+		elif len(event) == 5:
+			getattr(engine, event[0])(event[3], replay_assigns(engine, event[4], [], pending))
+		else:
+			getattr(engine, event[0])(event[3])
+
+# return nested assigns from recorded ones, filtering them with engine
+def replay_assigns(engine, entries, assigns, pending):
+	for entry in entries:
+		if entry[0] == "#pending":
+			pending[0] += entry[1]
+			pending[1].extend(entry[2])
+		elif entry[0] == "#filter":
+			if engine.filter(entry[1], nested_assigns = assigns):
+				replay_assigns(engine, entry[2], assigns, pending)
+		else:
+			assigns.append(entry)
+	return assigns
+
+# return AST of file, it is taken from cache if possible
+def load_ast(filename, text = None, cache = None):
+	if cache is None:
+		return record(filename, text)
+
+	if text is None:
+		key = cache.file_key(filename)
+	else:
+		key = cache.key(text)
+
+	events = cache.load("parse", key)
+	if events is None:
+		events = record(filename, text)
+		cache.save("parse", key, events)
+	return events
+
+def parse(engine, filename, text = None, cache = None):
+	# big files are not recorded, so they are never fully kept in memory
+	if (cache is None) or ((text is None) and (os.path.getsize(filename) > max_cached_file_size)):
+		parser = Parser(engine, filename, text)
+		parser.parse()
+		return
+
+	try:
+		events = load_ast(filename, text, cache)
+	except ValueError:
+		# recording also looks into disabled filters,
+		# so let regular parsing decide if this is an error
+		parser = Parser(engine, filename, text)
+		parser.parse()
+		return
+	replay(engine, events)
@@ -3,8 +3,12 @@
 import os
 import re
 import sys
+import time
 import shlex
 import shutil
+import filecmp
+import collections
+import multiprocessing.pool
 
 re_folder_part = re.compile(r"^((?:\(\[\^\\\/\]\*\)(?:\(\?\![\w\|]+\))?\(\[\^\\\/\]\*\)|(?:[^\r\n(\[\"\\]|\\.))+)(\\\/|\/|\\).*$") # match folder part in filename regex
 re_non_escaped_char = re.compile(r"(?<!\\)\\(.)") # looking for not escaped \ with char
@@ -12,6 +16,11 @@ re_capture_group_ref = re.compile(r"(?<!\\)\\(p?)(\d+)") # match regex capture g
 re_pattern_split = re.compile(r"(?<!\[\^)\/")
 re_recursive_glob = re.compile(r"\(\[\^\\\/\]\*\)(\(\?\![\w\|]+\))?\(\[\^\\\/\]\*\)\\\/")
 re_recursive_glob_noslash = re.compile(r"\(\[\^\/\]\*\)(\(\?\![\w\|]+\))?\(\[\^\/\]\*\)")
+re_regex_extension = re.compile(r"^(.*?)\\\.(?:\(((?:[\w-]|\\[+#-])+(?:\|(?:[\w-]|\\[+#-])+)*)\)|((?:[\w-]|\\[+#-])+))(?:\$|\\Z)$") # match regex that ends with \.ext$ or \.(ext1|ext2)$
+re_trailing_flags = re.compile(r"(?:\(\?[aiLmsux]+\))+$") # match inline flags in the end of regex
+re_ascii = re.compile(r"^[\x00-\x7f]*$")
+
+scandir = getattr(os, "scandir", None) # only available since python 3.5
 
 # return relative path to current work dir
 def rel_dir(filename):
@@ -20,8 +29,88 @@ def rel_dir(filename):
 		path = ""
 	return path
 
+# move file over existing one, os.replace is only available since python 3.3
+def replace_file(src, dst):
+	if sys.version_info[0:2] >= (3, 3):
+		os.replace(src, dst)
+	else:
+		# rename is not able to overwrite files on windows
+		if sys.platform == "win32" and os.path.exists(dst):
+			os.remove(dst)
+		os.rename(src, dst)
+
+# list like output that is written to temporary file as it's produced,
+# so big manifests are never kept in memory, file is moved into place only when output is complete
+# and only if it's different from existing file, so ninja doesn't see new mtime for same manifest
+class OutputFile:
+	def __init__(self, filename, lines = []):
+		self.filename = filename
+		self.temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+		self.file = open(self.temp_filename, "w", 1 << 16)
+		self.extend(lines)
+
+	def append(self, line):
+		self.file.write(line)
+		self.file.write("\n")
+
+	def extend(self, lines):
+		for line in lines:
+			self.append(line)
+
+	def close(self):
+		self.file.close()
+		if os.path.isfile(self.filename) and filecmp.cmp(self.temp_filename, self.filename, shallow = False):
+			os.remove(self.temp_filename)
+		else:
+			replace_file(self.temp_filename, self.filename)
+
+	# remove incomplete output
+	def discard(self):
+		self.file.close()
+		os.remove(self.temp_filename)
+
+# bounded cache, least recently used entries are evicted first
+# hits and misses are counted so effect of cache can be checked
+class LRUCache:
+	def __init__(self, size):
+		self.size = size
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	# return cached value or None
+	def get(self, key):
+		try:
+			value = self.entries.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+		self.entries[key] = value # move entry to the end, so it's evicted last
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		self.entries[key] = value
+		if len(self.entries) > self.size:
+			self.entries.popitem(last = False)
+
+# (filename, replace_groups, recursive capture groups): (regex, new recursive capture groups)
+wildcard_cache = LRUCache(4096)
+# regex: compiled regex
+regex_cache = LRUCache(4096)
+
+# return compiled regex, same regexes are compiled only once
+def compile_regex(regex):
+	compiled = regex_cache.get(regex)
+	if compiled is None:
+		compiled = re.compile(regex)
+		regex_cache.put(regex, compiled)
+	return compiled
+
 # return regex value in filename for regex or wildcard
 # replace_groups replace wildcards with group reference indexes
+# recursive capture groups are added to rec_capture_groups if replace_groups is false,
+# otherwise they are used to fill groups that are not present in filename
 def wildcard_regex(filename, replace_groups = False, rec_capture_groups = set()):
 	if filename.startswith("r\""):
 		return filename[2:-1] # strip r" and "
@@ -30,83 +119,291 @@ def wildcard_regex(filename, replace_groups = False, rec_capture_groups = set())
 		filename = filename[1:-1] # strip " and "
 
 	if "!" in filename or "*" in filename or "?" in filename or "[" in filename:
-		# based on fnmatch.translate with each wildcard is a capture group
-		i, n = 0, len(filename)
-		groups = 1
-		res = ""
-		while i < n:
-			c = filename[i]
-			i = i + 1
-			if c == "*":
-				if i < n and filename[i] == "*":
-					if replace_groups:
-						res += "\\p" + str(groups) # p (path) will mean that it's ok to substitute this group with string that may contain slashes
-					else:
-						res += "([^\/]*)([^\/]*)"
-						rec_capture_groups.add(groups)
-					i = i + 1
+		key = (filename, replace_groups, tuple(sorted(rec_capture_groups)) if replace_groups else None)
+		cached = wildcard_cache.get(key)
+		if cached is None:
+			new_capture_groups = set()
+			regex = translate_wildcard(filename, replace_groups, rec_capture_groups if replace_groups else new_capture_groups)
+			cached = (regex, new_capture_groups)
+			wildcard_cache.put(key, cached)
+		if not replace_groups:
+			rec_capture_groups.update(cached[1])
+		return cached[0]
+	else:
+		return None
+
+# translate wildcard to regex, based on fnmatch.translate with each wildcard is a capture group
+def translate_wildcard(filename, replace_groups, rec_capture_groups):
+	i, n = 0, len(filename)
+	groups = 1
+	res = ""
+	while i < n:
+		c = filename[i]
+		i = i + 1
+		if c == "*":
+			if i < n and filename[i] == "*":
+				if replace_groups:
+					res += "\\p" + str(groups) # p (path) will mean that it's ok to substitute this group with string that may contain slashes
 				else:
-					if replace_groups:
-						# if inputs have recursive capture groups and output don't use them
-						# then prepend recursive group to file name and just switch to next non recursive capture group
-						while groups in rec_capture_groups:
-							res += "\\" + str(groups) + "_"
-							groups += 1
-						res += "\\" + str(groups)
-					else:
-						res += "([^\/]*)"
-				groups += 1
-			elif c == "?":
+					res += "([^\/]*)([^\/]*)"
+					rec_capture_groups.add(groups)
+				i = i + 1
+			else:
 				if replace_groups:
+					# if inputs have recursive capture groups and output don't use them
+					# then prepend recursive group to file name and just switch to next non recursive capture group
+					while groups in rec_capture_groups:
+						res += "\\" + str(groups) + "_"
+						groups += 1
 					res += "\\" + str(groups)
 				else:
-					res += "([^\/])"
-				groups += 1
-			elif replace_groups:
-				res += c
-			elif c == "!":
-				j = i
-				if j < n and filename[j] == "(":
-					j = j + 1
-				while j < n and filename[j] != ")":
-					j = j + 1
-				if j >= n:
-					res += "\!"
-				else:
-					stuff = filename[i + 1: j].replace("\\", "\\\\")
-					i = j + 1
-					res += "(?!%s)([^\/]*)" % stuff
-			elif c == "[":
-				j = i
-				if j < n and filename[j] == "!":
-					j = j + 1
-				if j < n and filename[j] == "]":
-					j = j + 1
-				while j < n and filename[j] != "]":
-					j = j + 1
-				if j >= n:
-					res += "\\["
-				else:
-					stuff = filename[i:j].replace("\\", "\\\\")
-					i = j + 1
-					if stuff[0] == "!":
-						stuff = "^" + stuff[1:]
-					elif stuff[0] == "^":
-						stuff = "\\" + stuff
-					res = "%s([%s])" % (res, stuff)
+					res += "([^\/]*)"
+			groups += 1
+		elif c == "?":
+			if replace_groups:
+				res += "\\" + str(groups)
+			else:
+				res += "([^\/])"
+			groups += 1
+		elif replace_groups:
+			res += c
+		elif c == "!":
+			j = i
+			if j < n and filename[j] == "(":
+				j = j + 1
+			while j < n and filename[j] != ")":
+				j = j + 1
+			if j >= n:
+				res += "\!"
+			else:
+				stuff = filename[i + 1: j].replace("\\", "\\\\")
+				i = j + 1
+				res += "(?!%s)([^\/]*)" % stuff
+		elif c == "[":
+			j = i
+			if j < n and filename[j] == "!":
+				j = j + 1
+			if j < n and filename[j] == "]":
+				j = j + 1
+			while j < n and filename[j] != "]":
+				j = j + 1
+			if j >= n:
+				res += "\\["
 			else:
-				res += re.escape(c)
-		if replace_groups:
-			return res
+				stuff = filename[i:j].replace("\\", "\\\\")
+				i = j + 1
+				if stuff[0] == "!":
+					stuff = "^" + stuff[1:]
+				elif stuff[0] == "^":
+					stuff = "\\" + stuff
+				res = "%s([%s])" % (res, stuff)
 		else:
-			return "%s\Z(?ms)" % res
+			res += re.escape(c)
+	if replace_groups:
+		return res
 	else:
+		return "%s\Z(?ms)" % res
+
+# cache of directory listings, so file system is scanned only once
+# even if many engines are looking into same folders
+class DirCache:
+	def __init__(self, jobs = 1):
+		self.listings = {} # path: (dirs, files, linked dirs) or None if path is not a directory
+		self.mtimes = {} # path: modification time of directory when it was listed
+		self.stored = {} # path: (mtime, dirs, files, linked dirs) from previous runs
+		self.jobs = jobs # number of folders listed at same time, helps on file systems with high latency
+		self.pool = None
+
+	# return (dirs, files, linked dirs) of directory or None if path is not a directory
+	def list_dir(self, path):
+		listing = self.listings.get(path, False)
+		if listing is False:
+			listing, mtime = self.read_dir(path)
+			self.listings[path] = listing
+			self.mtimes[path] = mtime
+		return listing
+
+	# list many folders at once if jobs are enabled, listings are stored same way as with list_dir
+	def prefetch(self, paths):
+		paths = [path for path in paths if path not in self.listings]
+		if self.jobs <= 1 or len(paths) <= 1:
+			return
+		if self.pool is None:
+			self.pool = multiprocessing.pool.ThreadPool(self.jobs)
+		for path, (listing, mtime) in zip(paths, self.pool.map(self.read_dir, paths)):
+			self.listings[path] = listing
+			self.mtimes[path] = mtime
+
+	# stop threads that were started by prefetch, cache can be used after that without them
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+	# return (listing, mtime) of directory or (None, None) if path is not a directory,
+	# it doesn't change cache so it can be called from many threads
+	def read_dir(self, path):
+		try:
+			# directory mtime changes when entries are added, removed or renamed,
+			# so stored listing can be used if it has same mtime
+			mtime = os.stat(path).st_mtime
+			stored = self.stored.get(path)
+			if stored and stored[0] == mtime:
+				return (stored[1], stored[2], set(stored[3])), mtime
+			elif scandir:
+				return self.scan_dir(path), mtime
+			else:
+				return self.scan_dir_slow(path), mtime
+		except OSError:
+			return None, None
+
+	# use listings from index of previous run, it can be None or empty
+	def load_index(self, index):
+		self.stored = dict(index) if index else {}
+
+	# return listings that can be stored with marshal and loaded in next run with load_index,
+	# directories changed in last seconds are not stored because their mtime may not change again
+	# if they are changed again during same second, listings from previous runs that weren't used
+	# in this run are only kept if their directories weren't changed or removed since then
+	def index(self):
+		recent = time.time() - 2
+		index = {}
+		for path, stored in self.stored.items():
+			if path not in self.listings:
+				try:
+					if os.stat(path).st_mtime == stored[0]:
+						index[path] = stored
+				except OSError:
+					pass
+		for path, listing in self.listings.items():
+			mtime = self.mtimes.get(path)
+			if listing is not None and mtime is not None and mtime < recent:
+				index[path] = (mtime, listing[0], listing[1], sorted(listing[2]))
+		return index
+
+	# file types come from directory entries, so files don't need to be stat'ed except symlinks
+	def scan_dir(self, path):
+		dirs = []
+		files = []
+		linked_dirs = set()
+		for entry in scandir(path):
+			if entry.is_dir():
+				dirs.append(entry.name)
+				if entry.is_symlink():
+					linked_dirs.add(entry.name)
+			elif entry.is_file():
+				files.append(entry.name)
+		return (dirs, files, linked_dirs)
+
+	# same as scan_dir, but every entry is stat'ed
+	def scan_dir_slow(self, path):
+		dirs = []
+		files = []
+		linked_dirs = set()
+		for name in os.listdir(path):
+			full_name = os.path.join(path, name)
+			if os.path.isdir(full_name):
+				dirs.append(name)
+				if os.path.islink(full_name):
+					linked_dirs.add(name)
+			elif os.path.isfile(full_name):
+				files.append(name)
+		return (dirs, files, linked_dirs)
+
+	# same as os.walk with topdown, dirs list can be changed in place to prune walking,
+	# folders are also pruned if keep function returns False for their names
+	def walk(self, top, keep = None):
+		# if jobs are enabled then list whole tree first level by level,
+		# so all folders of same level are listed at same time
+		if self.jobs > 1:
+			level = [top]
+			while level:
+				self.prefetch(level)
+				next_level = []
+				for path in level:
+					listing = self.list_dir(path)
+					if listing is not None:
+						next_level.extend([os.path.join(path, dir) for dir in listing[0]
+							if dir not in listing[2] and (keep is None or keep(dir))])
+				level = next_level
+		return self.walk_listed(top, keep)
+
+	def walk_listed(self, top, keep):
+		listing = self.list_dir(top)
+		if listing is None:
+			return
+		dirs = [dir for dir in listing[0] if keep is None or keep(dir)]
+		yield top, dirs, list(listing[1])
+		for dir in dirs:
+			# os.walk doesn't follow symlinks by default
+			if dir not in listing[2]:
+				for result in self.walk_listed(os.path.join(top, dir), keep):
+					yield result
+
+# table of paths shared between engines, same strings are returned for same dirs and file names,
+# so big file lists of many variants don't keep many copies of them
+class PathTable:
+	def __init__(self):
+		self.aliases = {} # path as written: normalized path, only for paths that are changed by normalization
+		self.names = {} # dir or file name: same string
+
+	def normalize(self, path):
+		normalized = self.aliases.get(path)
+		if normalized is None:
+			normalized = os.path.normpath(path).replace("\\", "/")
+			if normalized == path:
+				return path # don't keep two copies of same string
+			self.aliases[path] = normalized
+		return normalized
+
+	# return (dir that ends with / or ./, file name) of normalized path
+	def split(self, path):
+		dir, name = os.path.split(path)
+		dir = dir + "/" if dir else "./"
+		return self.names.setdefault(dir, dir), self.names.setdefault(name, name)
+
+# return extension of file name, which is everything after last dot
+def file_extension(filename):
+	return filename.rsplit(".", 1)[1] if "." in filename else ""
+
+# return (set of extensions, ignore case) if regex only matches files with these extensions
+# or None if regex is too complex to tell this, extensions are lower case if case is ignored
+def regex_extensions(regex):
+	try:
+		flags = compile_regex(regex).flags
+	except re.error:
+		return None
+	if flags & re.VERBOSE:
+		return None
+	match = re_regex_extension.match(re_trailing_flags.sub("", regex))
+	if not match:
 		return None
+	# alternation or escaped backslash before extension could change meaning of regex
+	prefix = match.group(1)
+	if ("|" in prefix) or ((len(prefix) - len(prefix.rstrip("\\"))) % 2):
+		return None
+	extensions = (match.group(2) or match.group(3)).replace("\\", "").split("|")
+	ignore_case = bool(flags & re.IGNORECASE)
+	if ignore_case:
+		if not all(re_ascii.match(extension) for extension in extensions):
+			return None
+		extensions = [extension.lower() for extension in extensions]
+	return set(extensions), ignore_case
+
+# add folder of generated files to tree of generated folders,
+# tree is dict of folder name: sub tree, root folder ./ is tree itself
+def add_generated_folder(generated_tree, folder):
+	node = generated_tree
+	if folder != "./":
+		for name in folder.rstrip("/").split("/"):
+			node = node.setdefault(name, {})
 
 # return list of folders (always ends with /) that match provided pattern
 # please note that some result folders may point into non existing location
 # because it's too costly here to check if they exist
-def glob_folders(pattern, base_path, generated, excluded_dirs):
+# generated_tree is tree of generated folders from add_generated_folder
+def glob_folders(pattern, base_path, generated_tree, excluded_dirs, dir_cache):
 	if not pattern.endswith("/"): # this shouldn't fail
 		raise ValueError("pattern should always end with \"/\", but got \"%s\"" % pattern)
 
@@ -115,103 +412,186 @@ def glob_folders(pattern, base_path, generated, excluded_dirs):
 
 	pattern = pattern[2:] if pattern.startswith("./") else pattern
 
+	after_recursive = False
 	for folder in re_pattern_split.split(pattern):
 		recursive_match = re_recursive_glob_noslash.match(folder)
 		if recursive_match:
+			after_recursive = True
 			regex_filter = recursive_match.group(1)
-			re_regex_filter = re.compile("^%s.*$" % regex_filter) if regex_filter else None
+			re_regex_filter = compile_regex("^%s.*$" % regex_filter) if regex_filter else None
+
+			keep = lambda dir: dir not in excluded_dirs and (not re_regex_filter or re_regex_filter.match(dir))
 
 			new_real_folders = []
 			for real_folder in real_folders:
 				new_real_folders.append(real_folder)
-				for root, dirs, filenames in os.walk(real_folder, topdown = True): # TODO this is slow, optimize
-					dirs[:] = [dir for dir in dirs if dir not in excluded_dirs]
-					if re_regex_filter:
-						dirs[:] = [dir for dir in dirs if re_regex_filter.match(dir)]
+				for root, dirs, filenames in dir_cache.walk(real_folder, keep):
 					for dir in dirs:
 						result = os.path.join(root, dir).replace("\\", "/")
 						new_real_folders.append(result)
 			real_folders = new_real_folders
 
+			# walk through generated folders in similar fashion with os.walk
 			new_gen_folders = []
+			def walk_generated(node, path, prepend_dot):
+				new_gen_folders.append("./%s" % path if prepend_dot else path)
+				for name, sub_node in node.items():
+					if keep(name):
+						walk_generated(sub_node, "%s/%s" % (path, name), prepend_dot)
 			for gen_folder in gen_folders:
 				prepend_dot = False
 				if gen_folder.startswith("./"):
 					prepend_dot = True
 					gen_folder = gen_folder[2:] # strip ./
 
-				gen_folder_len = len(gen_folder)
-				for folder in generated.keys():
-					if folder.startswith(gen_folder):
-						root = folder[:gen_folder_len]
-						sub_folders = folder[gen_folder_len:]
-						sub_folders = sub_folders.lstrip("/").rstrip("/")
-						# walk through directories in similar fashion with os.walk
-						new_gen_folders.append("./%s" % root if prepend_dot else root)
-						for subfolder in sub_folders.split("/"): 
-							if subfolder in excluded_dirs:
-								break
-							if re_regex_filter and not re_regex_filter.match(subfolder):
-								break
-							root += "/%s" % subfolder
-							new_gen_folders.append("./%s" % root if prepend_dot else root)
+				node = generated_tree
+				if gen_folder != ".":
+					for name in gen_folder.split("/"):
+						node = node.get(name)
+						if node is None:
+							break
+				if node is not None:
+					walk_generated(node, gen_folder, prepend_dot)
 			gen_folders = list(set(new_gen_folders))
 		else:
+			# recursive glob gives many folders and usually only few of them have next folder,
+			# so keep only folders that have it, their listings are already cached by walk,
+			# names are compared without case because file system may ignore it
+			if after_recursive and folder and folder not in [".", ".."]:
+				lower_folder = folder.lower()
+				def has_folder(path):
+					listing = dir_cache.list_dir(path)
+					return listing is not None and any([dir.lower() == lower_folder for dir in listing[0]])
+				real_folders = [p for p in real_folders if has_folder(p)]
 			real_folders = ["%s/%s" % (p, folder) for p in real_folders]
 			gen_folders = ["%s/%s" % (p, folder) for p in gen_folders]
 
 	return (real_folders, gen_folders)
 
-# input can be string or list of strings
-# outputs are always lists
-def find_files(inputs, outputs = None, rel_path = "", generated = None, excluded_dirs = set()):
-	# rename regex back to readable form
-	def replace_non_esc(match_group):
-		return match_group.group(1)
+# return sorted list of files in folders that match base folder, including generated files,
+# file names are relative to lookup path, base folder is None if files are only in lookup path,
+# generated folders that were looked into are added to folders set if it's provided
+def glob_files(base_folder, lookup_path, generated, generated_tree, excluded_dirs, dir_cache, folders = None):
+	real_folders = [lookup_path]
+	gen_folders = [lookup_path]
+	if base_folder:
+		real_folders, gen_folders = glob_folders(base_folder, lookup_path, generated_tree, excluded_dirs, dir_cache)
+
+	# look for files
+	fs_files = set()
+	dir_cache.prefetch(real_folders)
+	for real_folder in real_folders:
+		listing = dir_cache.list_dir(real_folder)
+		if listing is not None:
+			root = real_folder[len(lookup_path):]
+			fs_files.update([root + file for file in listing[1]])
+
+	gen_files = set()
+	for gen_folder in gen_folders:
+		# in case if gen_folder is "./something" then we need to strip ./
+		# but if gen_folder is just "./" then we don't need to strip it !
+		if len(gen_folder) > 2 and gen_folder.startswith("./"):
+			check_folder = gen_folder[2:]
+		else:
+			check_folder = gen_folder
+		if folders is not None:
+			folders.add(check_folder)
+		if check_folder in generated:
+			root = gen_folder[len(lookup_path):]
+			gen_files.update([root + file for file in generated.get(check_folder)])
+
+	# we must have stable sort here
+	# so output ninja files will be same between runs
+	return sorted(fs_files.union(gen_files))
+
+# match files with many regexes at once, each file is only tested with regexes
+# that can match its extension, return list of (file, capture groups) for each regex
+def match_regexes(regexes, files):
+	found = [[] for regex in regexes]
+	matches = [compile_regex(regex).match for regex in regexes]
+	if len(regexes) == 1:
+		match_regex = matches[0]
+		for file in files:
+			match = match_regex(file)
+			if match:
+				found[0].append((file, match.groups()))
+		return found
+
+	all_indexes = list(range(len(regexes)))
+	any_extension = [] # indexes of regexes that can match any extension
+	by_extension = {} # extension: indexes of case sensitive regexes
+	by_lower_extension = {} # lower case extension: indexes of regexes that ignore case
+	for index, regex in enumerate(regexes):
+		extensions = regex_extensions(regex)
+		if extensions is None:
+			any_extension.append(index)
+		else:
+			for extension in extensions[0]:
+				(by_lower_extension if extensions[1] else by_extension).setdefault(extension, []).append(index)
+
+	candidates = {} # extension: indexes of regexes to test
+	for file in files:
+		# in multiline mode $ also matches before newline, so any line of name can end with extension
+		if "\n" in file:
+			indexes = all_indexes
+		else:
+			extension = file_extension(file)
+			indexes = candidates.get(extension)
+			if indexes is None:
+				# case of non ascii letters is complicated
+				if not re_ascii.match(extension):
+					indexes = all_indexes
+				else:
+					indexes = sorted(any_extension + by_extension.get(extension, []) + by_lower_extension.get(extension.lower(), []))
+				candidates[extension] = indexes
+		for index in indexes:
+			match = matches[index](file)
+			if match:
+				found[index].append((file, match.groups()))
+	return found
+
+# rename regex back to readable form
+def replace_non_esc(match_group):
+	return match_group.group(1)
+
+# find files that match inputs, input can be string or list of strings,
+# return (found files, capture groups of each matched file, recursive capture groups of inputs)
+# if folders set is provided then generated folders that were looked into are added to it,
+# if recursive_folders set is provided then folders where recursive globs start are added to it,
+# because result also depends on new generated folders inside of them
+def glob_inputs(inputs, rel_path = "", generated = None, excluded_dirs = set(), dir_cache = None, paths = None, generated_tree = None, folders = None, recursive_folders = None):
+	if generated is None:
+		generated = {}
+	if generated_tree is None:
+		generated_tree = {}
+		for folder in generated.keys():
+			add_generated_folder(generated_tree, folder)
+	if dir_cache is None:
+		dir_cache = DirCache()
+	if paths is None:
+		paths = PathTable()
 	rec_capture_groups = set()
+	matched = []
 	if inputs:
-		result = []
-		matched = []
-		for input in inputs:
+		# inputs are grouped by folder part of their regexes,
+		# so files of each folder are found and matched only once for all inputs in group
+		lookup_path = rel_path if rel_path else "./"
+		regexes = []
+		groups = collections.OrderedDict() # base folder: indexes of inputs
+		for index, input in enumerate(inputs):
 			regex = wildcard_regex(input, False, rec_capture_groups)
 			if regex:
 				# find the folder where to look for files
 				base_folder = re_folder_part.match(regex)
-				lookup_path = rel_path if rel_path else "./"
-				real_folders = [lookup_path]
-				gen_folders = [lookup_path]
 				if base_folder:
 					base_folder = base_folder.group(1) + base_folder.group(2)
 					base_folder = re_non_escaped_char.sub(replace_non_esc, base_folder)
 					if "\\" in base_folder:
 						raise ValueError("please only use forward slashes in path \"%s\"" % input)
-					real_folders, gen_folders = glob_folders(base_folder, lookup_path, generated, excluded_dirs)
-
-				# look for files
-				fs_files = set()
-				for real_folder in real_folders:
-					if os.path.isdir(real_folder):
-						root = real_folder[len(lookup_path):]
-						files = [root + file for file in os.listdir(real_folder) if os.path.isfile(real_folder + "/" + file)]
-						fs_files = fs_files.union(files)
-
-				gen_files = set()
-				for gen_folder in gen_folders:
-					# in case if gen_folder is "./something" then we need to strip ./
-					# but if gen_folder is just "./" then we don't need to strip it !
-					if len(gen_folder) > 2 and gen_folder.startswith("./"):
-						check_folder = gen_folder[2:]
-					else:
-						check_folder = gen_folder
-					if check_folder in generated:
-						root = gen_folder[len(lookup_path):]
-						files = [root + file for file in generated.get(check_folder)]
-						gen_files = gen_files.union(files)
-
-				# we must have stable sort here
-				# so output ninja files will be same between runs
-				all_files = list(fs_files.union(gen_files))
-				all_files = sorted(all_files)
+					recursive_match = re_recursive_glob_noslash.search(base_folder)
+					if recursive_folders is not None and recursive_match:
+						recursive_folder = os.path.normpath(lookup_path + base_folder[:recursive_match.start()]).replace("\\", "/")
+						recursive_folders.add(recursive_folder + "/" if recursive_folder != "." else "./")
 
 				# while capturing ** we want just to capture */ optionally
 				# so we can match files in root folder as well
@@ -224,16 +604,37 @@ def find_files(inputs, outputs = None, rel_path = "", generated = None, excluded
 				if regex.startswith("\.\/"):
 					regex = regex[4:]
 
-				re_regex = re.compile(regex)
-				for file in all_files:
-					match = re_regex.match(file)
-					if match:
-						result.append(rel_path + file)
-						matched.append(match.groups())
-			else:
+				groups.setdefault(base_folder, []).append(index)
+			regexes.append(regex)
+
+		found = [None] * len(inputs) # (file, capture groups) of each input with regex
+		for base_folder, indexes in groups.items():
+			files = glob_files(base_folder, lookup_path, generated, generated_tree, excluded_dirs, dir_cache, folders)
+			for index, input_found in zip(indexes, match_regexes([regexes[index] for index in indexes], files)):
+				found[index] = input_found
+
+		result = []
+		for input, input_found in zip(inputs, found):
+			if input_found is None:
 				result.append(rel_path + input)
+			else:
+				for file, groups in input_found:
+					result.append(rel_path + file)
+					matched.append(groups)
 		inputs = result
 
+	return [paths.normalize(file) for file in inputs], matched, rec_capture_groups
+
+# input can be string or list of strings
+# outputs are always lists
+# found is result of glob_inputs for same inputs if it's already known
+def find_files(inputs, outputs = None, rel_path = "", generated = None, excluded_dirs = set(), dir_cache = None, paths = None, generated_tree = None, found = None):
+	if paths is None:
+		paths = PathTable()
+	if found is None:
+		found = glob_inputs(inputs, rel_path, generated, excluded_dirs, dir_cache, paths, generated_tree)
+	inputs, matched, rec_capture_groups = found
+
 	if outputs:
 		result = []
 		for output in outputs:
@@ -263,15 +664,13 @@ def find_files(inputs, outputs = None, rel_path = "", generated = None, excluded
 				result.append(rel_path + output)
 
 		# normalize results
-		result = [os.path.normpath(file).replace("\\", "/") for file in result]
-
-	# normalize inputs
-	inputs = [os.path.normpath(file).replace("\\", "/") for file in inputs]
+		result = [paths.normalize(file) for file in result]
 
+	# found inputs may be shared, so return a copy of them
 	if outputs:
-		return inputs, result
+		return list(inputs), result
 	else:
-		return inputs
+		return list(inputs)
 
 # finds the file in path
 def which(cmd, mode = os.F_OK | os.X_OK, path = None):
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
 import json
 import glob
+import shutil
 import fnmatch
+import tempfile
 import argparse
 import traceback
 import subprocess
@@ -12,8 +15,11 @@ from pprint import pprint
 from deepdiff import DeepDiff # pip install deepdiff
 
 sys.path.append("..")
-from lib_parser import parse
+from lib_parser import parse, record, replay
 from lib_engine import Engine
+from lib_util import DirCache, match_regexes
+from lib_cache import Cache
+from buildfox import fox_core
 
 class EngineMock:
 	def __init__(self):
@@ -137,6 +143,15 @@ def run_test(test_filename, print_json = False, print_ninja = False):
 					pprint(diff)
 					return False
 
+				# recorded events should be replayed exactly as they were parsed
+				engine = EngineMock()
+				replay(engine, record(test_filename))
+				diff = DeepDiff(reference, engine.output)
+				if diff:
+					print("Replayed results differ from reference:")
+					pprint(diff)
+					return False
+
 		ninja_filename = os.path.splitext(test_filename)[0] + ".ninja"
 		ninja_exists = os.path.isfile(ninja_filename)
 		if ninja_exists or print_ninja:
@@ -155,6 +170,33 @@ def run_test(test_filename, print_json = False, print_ninja = False):
 					pprint(diff)
 					return False
 
+				# listing folders in many threads must give same results
+				engine = Engine()
+				engine.context.dir_cache = DirCache(4)
+				engine.load(test_filename, logo = False)
+				engine.context.dir_cache.close()
+				diff = DeepDiff(reference, engine.text())
+				if diff:
+					print("Results with many scan jobs differ from reference:")
+					pprint(diff)
+					return False
+
+		generated_filename = os.path.splitext(test_filename)[0] + ".gen.ninja"
+		if os.path.isfile(generated_filename):
+			# generated ninja file also has the rule that runs buildfox again
+			engine = Engine()
+			engine.generate(test_filename, "__gen_test.ninja", logo = False, generator_command = "buildfox")
+			with open("__gen_test.ninja", "r") as f:
+				generated = f.read()
+			os.remove("__gen_test.ninja")
+			with open(generated_filename, "r") as f:
+				reference = f.read()
+			diff = DeepDiff(reference, generated)
+			if diff:
+				print("Generated results differ from reference:")
+				pprint(diff)
+				return False
+
 		if not (json_exists or print_json or ninja_exists or print_ninja):
 			print("json and ninja files are not present")
 			return False
@@ -166,6 +208,177 @@ def run_test(test_filename, print_json = False, print_ninja = False):
 		traceback.print_exc()
 		return False
 
+# ninja files must be generated again only if something changed since previous run
+def run_manifest_test():
+	print("-> Testing generation skipping")
+	workdir = tempfile.mkdtemp()
+	try:
+		shutil.rmtree(workdir)
+		shutil.copytree("../examples/console_app/simple", workdir)
+		manifest = os.path.join(workdir, "build.ninja.manifest")
+		def generate(*args):
+			if subprocess.call([sys.executable, "../buildfox.py", "-w", workdir, "--no-env", "--just-generate", "toolset=gcc"] + list(args)):
+				raise ValueError("buildfox failed")
+			stat = os.stat(manifest)
+			return stat.st_mtime, stat.st_ino
+
+		first = generate()
+		if generate() != first:
+			print("Second run without changes generated ninja files again")
+			return False
+		with open(os.path.join(workdir, "new.cpp"), "w") as f:
+			f.write("")
+		second = generate()
+		if second == first:
+			print("Ninja files were not generated again after new file was added")
+			return False
+		# generator command in ninja files has all arguments
+		if generate("--scan-jobs", "2") == second:
+			print("Ninja files were not generated again after arguments were changed")
+			return False
+		return True
+	except:
+		traceback.print_exc()
+		return False
+	finally:
+		shutil.rmtree(workdir, ignore_errors = True)
+
+# every variant must be generated same way as if it was generated alone
+def run_variants_test():
+	print("-> Testing variants")
+	workdir = tempfile.mkdtemp()
+	try:
+		def generate(folder, *args):
+			path = os.path.join(workdir, folder)
+			if not os.path.exists(path):
+				shutil.copytree("../examples/static_lib/withapp", path)
+				with open(os.path.join(path, "build.fox"), "a") as f:
+					f.write("subfox test1/build.fox\n")
+				with open(os.path.join(path, "test1", "build.fox"), "w") as f:
+					f.write("build objects(build/sub_${variation}/*): auto *.c\n")
+			with open(os.devnull, "w") as devnull:
+				return subprocess.call([sys.executable, "../buildfox.py", "-w", path, "--no-env", "--just-generate", "toolset=gcc"] + list(args), stderr = devnull)
+
+		def read(folder, pattern):
+			filenames = glob.glob(os.path.join(workdir, folder, pattern))
+			if len(filenames) != 1:
+				raise ValueError("expected one file for %s in %s, found %s" % (pattern, folder, filenames))
+			with open(filenames[0], "r") as f:
+				return f.read()
+
+		if generate("multi", "variation=debug,release"):
+			raise ValueError("buildfox failed")
+		for variant in ["debug", "release"]:
+			if generate(variant, "variation=" + variant):
+				raise ValueError("buildfox failed")
+			# only names of variant files and arguments of generator are different
+			for multi_pattern, single_pattern in [("build_%s.ninja", "build.ninja"), ("__gen_build_*_%s.ninja", "__gen_build_*.ninja")]:
+				multi = read("multi", multi_pattern % variant)
+				multi = multi.replace("_%s.ninja" % variant, ".ninja").replace("variation=debug,release", "variation=" + variant)
+				if multi != read(variant, single_pattern):
+					print("Variant %s in %s is different from single variant %s" % (variant, multi_pattern % variant, single_pattern))
+					return False
+
+		for args in [["--selftest"], ["--ide", "make"]]:
+			if not generate("multi", "variation=debug,release", *args):
+				print("%s didn't fail with many variants" % " ".join(args))
+				return False
+		return True
+	except:
+		traceback.print_exc()
+		return False
+	finally:
+		shutil.rmtree(workdir, ignore_errors = True)
+
+# core loaded from cache must be same as parsed core
+def run_core_cache_test():
+	print("-> Testing core cache")
+	path = tempfile.mkdtemp()
+	try:
+		def load_core(cache):
+			engine = Engine()
+			engine.context.cache = cache
+			engine.on_assign(("toolset", "gcc", "="))
+			engine.on_assign(("variation", "debug", "="))
+			engine.load_core(fox_core)
+			return engine
+
+		reference = load_core(None).text()
+		cold = load_core(Cache(path))
+		if len(os.listdir(os.path.join(path, "core"))) != 1:
+			print("Core wasn't stored in cache")
+			return False
+		cache = Cache(path)
+		restored = load_core(cache)
+		for name, engine in [("Parsed", cold), ("Restored", restored)]:
+			if engine.text() != reference:
+				print("%s core is different from core loaded without cache" % name)
+				return False
+
+		# restored engine must not change stored snapshot
+		state = [value for (kind, key), value in cache.entries.items() if kind == "core"][0]
+		if restored.output is state[6]:
+			print("Restored core shares output with cached snapshot")
+			return False
+		restored.output.append("changed")
+		restored.on_assign(("changed", "1", "="))
+		if load_core(cache).text() != reference:
+			print("Changes of restored core are visible in cached snapshot")
+			return False
+		return True
+	except:
+		traceback.print_exc()
+		return False
+	finally:
+		shutil.rmtree(path, ignore_errors = True)
+
+# matching many regexes at once must find same files as matching each regex alone
+def run_match_test():
+	print("-> Testing regex matching")
+	regexes = [r"(?m).*\.cpp$", r".*\.h\Z", r"(?i).*\.C$", r"(.*)\.(c|h)$"]
+	files = ["a.cpp", "a.cpp\nb.h", "b.h", "c.C", "d.c", "e.c\nf", "g"]
+	expected = [[(file, re.match(regex, file).groups()) for file in files if re.match(regex, file)] for regex in regexes]
+	found = match_regexes(regexes, files)
+	if found != expected:
+		print("Regexes matched %s instead of %s" % (found, expected))
+		return False
+
+	# auto presets are picked by extension of first input, but names with newlines can match other extensions
+	engine = Engine()
+	engine.auto_presets["cc"] = (["r\"(?m).*\\.cpp$\""], ["r\".*\""], [])
+	try:
+		engine.eval_auto(["a.cpp\nb.h"], ["a.o"])
+	except ValueError:
+		print("Auto preset didn't match name with newline")
+		return False
+	return True
+
+# cache entries that weren't used for long time must be removed
+def run_cache_test():
+	print("-> Testing cache pruning")
+	path = tempfile.mkdtemp()
+	try:
+		cache = Cache(path)
+		cache.save("test", "used", 1)
+		cache.save("test", "unused", 2)
+		cache.save("test", "recent", 3)
+		old = os.stat(os.path.join(path, "test", "used")).st_mtime - 2 * 60 * 60
+		os.utime(os.path.join(path, "test", "used"), (old, old))
+		os.utime(os.path.join(path, "test", "unused"), (old, old))
+
+		cache = Cache(path)
+		cache.load("test", "used")
+		cache.prune(60 * 60)
+		if sorted(os.listdir(os.path.join(path, "test"))) != ["recent", "used"]:
+			print("Cache has wrong entries after pruning: %s" % os.listdir(os.path.join(path, "test")))
+			return False
+		return True
+	except:
+		traceback.print_exc()
+		return False
+	finally:
+		shutil.rmtree(path, ignore_errors = True)
+
 def run_suite(args):
 	results = []
 	for test_filename in glob.glob(args.get("in")):
@@ -173,6 +386,19 @@ def run_suite(args):
 		results.append(result)
 		if args.get("failfast") and not result:
 			break
+	if all(results) or not args.get("failfast"):
+		# tests from suite/root are run in their folder, so their files are in root folder of the build
+		os.chdir("suite/root")
+		try:
+			for test_filename in glob.glob("*.fox"):
+				results.append(run_test(test_filename, args.get("json"), args.get("show_ninja")))
+		finally:
+			os.chdir("../..")
+		results.append(run_manifest_test())
+		results.append(run_variants_test())
+		results.append(run_core_cache_test())
+		results.append(run_match_test())
+		results.append(run_cache_test())
 
 	if not all(results):
 		print("One or more tests from test suite failed")